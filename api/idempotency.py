@@ -0,0 +1,129 @@
+"""
+Idempotency for inbound webhooks.
+
+A delivery is identified by (endpoint, key): the provider's event id when there is one
+(Stripe), otherwise a SHA-256 of the canonical JSON payload (GHL). The first delivery
+claims a WebhookDelivery row (unique constraint, so the claim is atomic) and its response
+is stored. Duplicates inside the endpoint's window get that response back without
+running the view. A duplicate that arrives while the first is still running gets a 409
+so the provider retries it later.
+"""
+import functools
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+
+from .models import WebhookDelivery
+
+logger = logging.getLogger(__name__)
+
+
+def payload_hash_key(request):
+    """SHA-256 of the request body, as canonical JSON when it parses"""
+    try:
+        canonical = json.dumps(json.loads(request.body), sort_keys=True, separators=(",", ":")).encode()
+    except ValueError:
+        canonical = request.body
+    return hashlib.sha256(canonical).hexdigest()
+
+
+def stripe_event_key(request):
+    """Stripe's event id (evt_...), falling back to the payload hash"""
+    try:
+        event_id = json.loads(request.body).get("id")
+    except (ValueError, AttributeError):
+        event_id = None
+    return event_id or payload_hash_key(request)
+
+
+def claim(endpoint, key):
+    """
+    Claim a delivery for processing.
+
+    Returns:
+        tuple: (WebhookDelivery, claimed). claimed is False when another delivery with the
+            same key is done or still processing inside its window.
+    """
+    window = timedelta(seconds=settings.WEBHOOK_IDEMPOTENCY_WINDOWS.get(endpoint, settings.WEBHOOK_IDEMPOTENCY_DEFAULT_WINDOW))
+    processing_timeout = timedelta(seconds=settings.WEBHOOK_IDEMPOTENCY_PROCESSING_TIMEOUT)
+
+    for _ in range(2):
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                return WebhookDelivery.objects.create(endpoint=endpoint, key=key, expires_at=now + window), True
+        except IntegrityError:
+            pass
+
+        # Take over a record whose window has passed, or whose processing was abandoned
+        # (the worker died). The conditional UPDATE lets exactly one delivery win.
+        taken = WebhookDelivery.objects.filter(endpoint=endpoint, key=key).filter(
+            Q(expires_at__lte=now) | Q(status="processing", updated_at__lte=now - processing_timeout)
+        ).update(status="processing", response_status=None, response_body=None, expires_at=now + window, updated_at=now)
+
+        try:
+            return WebhookDelivery.objects.get(endpoint=endpoint, key=key), bool(taken)
+        except WebhookDelivery.DoesNotExist:
+            # Released between our insert and read; try to claim again
+            continue
+    raise RuntimeError(f"Could not claim webhook delivery {endpoint}:{key}")
+
+
+def complete(delivery, response):
+    """Store the response so duplicates can be answered with it"""
+    try:
+        body = json.loads(response.content)
+    except ValueError:
+        body = {"message": response.content.decode(errors="replace")}
+    delivery.status = "done"
+    delivery.response_status = response.status_code
+    delivery.response_body = body
+    delivery.save(update_fields=["status", "response_status", "response_body", "updated_at"])
+
+
+def release(delivery):
+    """Forget a failed delivery so the provider's retry is processed normally"""
+    WebhookDelivery.objects.filter(pk=delivery.pk).delete()
+
+
+def idempotent_webhook(endpoint, key_func=payload_hash_key):
+    """
+    Decorator for function webhook views. POSTs are deduplicated by key_func(request).
+    Responses with status 5xx (and exceptions) release the claim so retries run again.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != "POST":
+                return view(request, *args, **kwargs)
+
+            key = key_func(request)
+            delivery, claimed = claim(endpoint, key)
+            if not claimed:
+                if delivery.status == "done":
+                    logger.info(f"Duplicate {endpoint} webhook {key}; replaying stored response")
+                    response = JsonResponse(delivery.response_body, status=delivery.response_status, safe=False)
+                    response["Idempotent-Replayed"] = "true"
+                    return response
+                logger.info(f"Duplicate {endpoint} webhook {key} while the first is still processing")
+                return JsonResponse({"message": "Duplicate delivery is still being processed"}, status=409)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                release(delivery)
+                raise
+            if response.status_code >= 500:
+                release(delivery)
+            else:
+                complete(delivery, response)
+            return response
+        return wrapper
+    return decorator
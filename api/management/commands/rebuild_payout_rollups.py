@@ -0,0 +1,38 @@
+from zoneinfo import ZoneInfo
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+from api.models import Payout, PayoutDailyRollup
+
+
+class Command(BaseCommand):
+    help = "Rebuild PayoutDailyRollup from scratch by aggregating every Payout per user and America/Chicago day"
+
+    def handle(self, *args, **options):
+        daily_totals = (
+            Payout.objects
+            .annotate(day=TruncDate("created_at", tzinfo=ZoneInfo("America/Chicago")))
+            .values("user_id", "day")
+            .annotate(total=Sum("amount"), payout_count=Count("id"))
+            .order_by()
+        )
+
+        with transaction.atomic():
+            PayoutDailyRollup.objects.all().delete()
+            rollups = PayoutDailyRollup.objects.bulk_create(
+                (
+                    PayoutDailyRollup(
+                        user_id=row["user_id"],
+                        day=row["day"],
+                        total=row["total"],
+                        payout_count=row["payout_count"],
+                    )
+                    for row in daily_totals.iterator()
+                ),
+                batch_size=1000,
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(rollups)} payout rollups"))
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:06
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_invoice_tip_amount_invoice_tip_notes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceWebhookRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('created', 'Created'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('ghl_invoice_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('invoice', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='webhook_requests', to='api.invoice')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_invoicewebhookrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GHLProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.CharField(max_length=100)),
+                ('normalized_name', models.CharField(max_length=500)),
+                ('name', models.CharField(max_length=500)),
+                ('product_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('price_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('location_id', 'normalized_name'), name='unique_ghl_product_per_location')],
+            },
+        ),
+    ]
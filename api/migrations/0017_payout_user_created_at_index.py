@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_ghlproduct'),
+        ('ghl_auth', '0008_ghlauthcredentials_issued_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payout',
+            index=models.Index(fields=['user', 'created_at'], name='api_payout_user_id_da24ec_idx'),
+        ),
+    ]
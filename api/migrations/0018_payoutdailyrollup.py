@@ -0,0 +1,49 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:14
+
+from zoneinfo import ZoneInfo
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def populate_rollups(apps, schema_editor):
+    Payout = apps.get_model('api', 'Payout')
+    PayoutDailyRollup = apps.get_model('api', 'PayoutDailyRollup')
+    daily_totals = (
+        Payout.objects
+        .annotate(day=TruncDate('created_at', tzinfo=ZoneInfo('America/Chicago')))
+        .values('user_id', 'day')
+        .annotate(total=Sum('amount'), payout_count=Count('id'))
+        .order_by()
+    )
+    PayoutDailyRollup.objects.bulk_create(
+        [PayoutDailyRollup(user_id=row['user_id'], day=row['day'], total=row['total'], payout_count=row['payout_count']) for row in daily_totals],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_payout_user_created_at_index'),
+        ('ghl_auth', '0008_ghlauthcredentials_issued_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayoutDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('payout_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payout_rollups', to='ghl_auth.ghluser')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day'), name='unique_payout_rollup_per_user_day')],
+            },
+        ),
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:14
+
+from zoneinfo import ZoneInfo
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+from django.db.models.functions import TruncDate
+
+
+def remove_duplicate_payouts(apps, schema_editor):
+    """Renamed opportunities produced a second payout per user; keep the oldest one and rebuild the rollups."""
+    Payout = apps.get_model('api', 'Payout')
+    PayoutDailyRollup = apps.get_model('api', 'PayoutDailyRollup')
+
+    duplicates = (
+        Payout.objects.values('opportunity_id', 'user_id')
+        .annotate(keep_id=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    removed = 0
+    for row in duplicates:
+        removed += Payout.objects.filter(
+            opportunity_id=row['opportunity_id'], user_id=row['user_id'],
+        ).exclude(id=row['keep_id']).delete()[0]
+
+    if not removed:
+        return
+
+    PayoutDailyRollup.objects.all().delete()
+    daily_totals = (
+        Payout.objects
+        .annotate(day=TruncDate('created_at', tzinfo=ZoneInfo('America/Chicago')))
+        .values('user_id', 'day')
+        .annotate(total=Sum('amount'), payout_count=Count('id'))
+        .order_by()
+    )
+    PayoutDailyRollup.objects.bulk_create(
+        [PayoutDailyRollup(user_id=row['user_id'], day=row['day'], total=row['total'], payout_count=row['payout_count']) for row in daily_totals],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_payoutdailyrollup'),
+        ('ghl_auth', '0008_ghlauthcredentials_issued_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_payouts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='payout',
+            constraint=models.UniqueConstraint(fields=('opportunity_id', 'user'), name='unique_payout_per_opportunity_user'),
+        ),
+    ]
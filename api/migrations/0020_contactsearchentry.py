@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:17
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_payout_unique_opportunity_user'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='ContactSearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('external_id', models.BigIntegerField(unique=True)),
+                ('contact_id', models.CharField(max_length=100, unique=True)),
+                ('first_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('last_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('phone', models.CharField(blank=True, max_length=15, null=True)),
+                ('email', models.EmailField(blank=True, max_length=254, null=True)),
+                ('dnd', models.BooleanField(default=False)),
+                ('country', models.CharField(blank=True, max_length=50, null=True)),
+                ('date_added', models.DateTimeField(blank=True, null=True)),
+                ('tags', models.JSONField(blank=True, default=list)),
+                ('custom_fields', models.JSONField(blank=True, default=list)),
+                ('location_id', models.CharField(max_length=100)),
+                ('timestamp', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('search_text', models.TextField(blank=True, default='')),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['search_text'], name='contact_search_text_trgm', opclasses=['gin_trgm_ops'])],
+            },
+        ),
+    ]
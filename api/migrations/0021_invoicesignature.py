@@ -0,0 +1,59 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:21
+
+import base64
+import binascii
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_signatures(apps, schema_editor):
+    Invoice = apps.get_model('api', 'Invoice')
+    InvoiceSignature = apps.get_model('api', 'InvoiceSignature')
+    signed = Invoice.objects.exclude(signature__isnull=True).exclude(signature='').only('id', 'signature')
+    for invoice in signed.iterator(chunk_size=200):
+        value = invoice.signature
+        content_type = 'image/png'
+        if value.startswith('data:'):
+            header, _, value = value.partition(',')
+            content_type = header[len('data:'):].split(';')[0] or content_type
+        try:
+            image = base64.b64decode(value, validate=True)
+        except binascii.Error:
+            # Not base64; keep the original text rather than lose the signature
+            content_type, image = 'text/plain', invoice.signature.encode()
+        InvoiceSignature.objects.create(
+            invoice_id=invoice.id,
+            content_type=content_type,
+            data=zlib.compress(image),
+            digest=hashlib.sha256(image).hexdigest(),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_contactsearchentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceSignature',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_type', models.CharField(default='image/png', max_length=100)),
+                ('data', models.BinaryField()),
+                ('digest', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('invoice', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='signature_image', to='api.invoice')),
+            ],
+        ),
+        migrations.RunPython(move_signatures, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='invoice',
+            name='signature',
+        ),
+    ]
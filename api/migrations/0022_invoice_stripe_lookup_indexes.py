@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_invoicesignature'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['stripe_checkout_session_id'], name='api_invoice_stripe__f9fa46_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['stripe_payment_intent_id'], name='api_invoice_stripe__914d48_idx'),
+        ),
+    ]
@@ -0,0 +1,157 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:24
+
+import ast
+import json
+from datetime import timedelta
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.migrations.operations.base import Operation
+
+LEGACY_TABLE = 'api_webhooklog_legacy'
+
+
+def month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(value):
+    return month_start(month_start(value) + timedelta(days=32))
+
+
+def parse_legacy(text):
+    """Old rows hold the repr() of the payload dict"""
+    if not text:
+        return None
+    for parse in (ast.literal_eval, json.loads):
+        try:
+            return parse(text)
+        except (ValueError, SyntaxError, TypeError):
+            continue
+    return {'raw': text}
+
+
+class PartitionWebhookLog(Operation):
+    """
+    Rebuild api_webhooklog with a JSON `data` column plus source / event_type. On
+    PostgreSQL the new table is range-partitioned by month on received_at (primary key
+    (id, received_at), monthly partitions plus a default one); other databases get a
+    plain table. Existing rows are converted and copied over.
+    """
+    reversible = False
+
+    def __init__(self, state_operations):
+        self.state_operations = state_operations
+
+    def deconstruct(self):
+        return (self.__class__.__name__, [self.state_operations], {})
+
+    def state_forwards(self, app_label, state):
+        for operation in self.state_operations:
+            operation.state_forwards(app_label, state)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        old_model = from_state.apps.get_model(app_label, 'WebhookLog')
+        new_model = to_state.apps.get_model(app_label, 'WebhookLog')
+        table = new_model._meta.db_table
+        connection = schema_editor.connection
+
+        schema_editor.alter_db_table(old_model, table, LEGACY_TABLE)
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT MIN(received_at) FROM "{LEGACY_TABLE}"')
+                oldest = cursor.fetchone()[0]
+            schema_editor.execute(f'CREATE SEQUENCE "{table}_log_id_seq"')
+            schema_editor.execute(
+                f'CREATE TABLE "{table}" ('
+                f'"id" bigint NOT NULL DEFAULT nextval(\'{table}_log_id_seq\'), '
+                f'"received_at" timestamp with time zone NOT NULL, '
+                f'"source" varchar(50) NOT NULL, '
+                f'"event_type" varchar(100) NULL, '
+                f'"data" jsonb NULL, '
+                f'CONSTRAINT "{table}_partitioned_pkey" PRIMARY KEY ("id", "received_at")'
+                f') PARTITION BY RANGE ("received_at")'
+            )
+            schema_editor.execute(f'ALTER SEQUENCE "{table}_log_id_seq" OWNED BY "{table}"."id"')
+            schema_editor.execute(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT')
+
+            month = month_start(oldest or django.utils.timezone.now())
+            last = next_month(next_month(django.utils.timezone.now()))
+            while month <= last:
+                schema_editor.execute(
+                    f'CREATE TABLE "{table}_y{month.year}m{month.month:02d}" PARTITION OF "{table}" '
+                    f'FOR VALUES FROM (%s) TO (%s)',
+                    params=[month, next_month(month)],
+                )
+                month = next_month(month)
+            for index in new_model._meta.indexes:
+                schema_editor.add_index(new_model, index)
+        else:
+            schema_editor.create_model(new_model)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT received_at, data FROM "{LEGACY_TABLE}" ORDER BY id')
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                logs = []
+                for received_at, text in rows:
+                    data = parse_legacy(text)
+                    logs.append(new_model(
+                        received_at=received_at,
+                        source='legacy',
+                        event_type=data.get('type') if isinstance(data, dict) else None,
+                        data=data,
+                    ))
+                new_model.objects.using(schema_editor.connection.alias).bulk_create(logs)
+
+        schema_editor.execute(f'DROP TABLE "{LEGACY_TABLE}"')
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        raise NotImplementedError('Partitioning the webhook log cannot be reversed')
+
+    def describe(self):
+        return 'Rebuild WebhookLog as a JSON, source / event_type tagged table (monthly partitions on PostgreSQL)'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_invoice_stripe_lookup_indexes'),
+    ]
+
+    operations = [
+        PartitionWebhookLog([
+            migrations.AddField(
+                model_name='webhooklog',
+                name='event_type',
+                field=models.CharField(blank=True, max_length=100, null=True),
+            ),
+            migrations.AddField(
+                model_name='webhooklog',
+                name='source',
+                field=models.CharField(choices=[('ghl_invoice', 'GHL invoice'), ('ghl_user', 'GHL user'), ('ghl_payroll', 'GHL payroll'), ('ghl_invoice_paid', 'GHL invoice paid'), ('stripe', 'Stripe'), ('legacy', 'Legacy (before source was recorded)')], default='legacy', max_length=50),
+                preserve_default=False,
+            ),
+            migrations.AlterField(
+                model_name='webhooklog',
+                name='data',
+                field=models.JSONField(blank=True, null=True),
+            ),
+            migrations.AlterField(
+                model_name='webhooklog',
+                name='received_at',
+                field=models.DateTimeField(default=django.utils.timezone.now),
+            ),
+            migrations.AddIndex(
+                model_name='webhooklog',
+                index=models.Index(fields=['source', 'event_type', 'received_at'], name='api_webhook_source_8c5e9f_idx'),
+            ),
+            migrations.AddIndex(
+                model_name='webhooklog',
+                index=models.Index(fields=['received_at'], name='api_webhook_receive_5f3634_idx'),
+            ),
+        ]),
+    ]
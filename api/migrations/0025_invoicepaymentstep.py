@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_webhookdelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoicePaymentStep',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step', models.CharField(choices=[('ghl_payment', 'Record payment in GHL'), ('ghl_paid_tag', 'Add invoice_paid tag'), ('tip_webhook', 'Service Pilot tip webhook')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('retrying', 'Retrying'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_steps', to='api.invoice')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('invoice', 'step'), name='unique_invoice_payment_step')],
+            },
+        ),
+    ]
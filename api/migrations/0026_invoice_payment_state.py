@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+def backfill_paid(apps, schema_editor):
+    Invoice = apps.get_model('api', 'Invoice')
+    Invoice.objects.filter(status='paid').update(payment_state='paid')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_invoicepaymentstep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='payment_state',
+            field=models.CharField(choices=[('unpaid', 'Unpaid'), ('processing', 'Processing'), ('paid', 'Paid'), ('failed', 'Failed'), ('expired', 'Expired')], default='unpaid', max_length=20),
+        ),
+        migrations.RunPython(backfill_paid, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_invoice_payment_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='stripe_checkout_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='stripe_checkout_fingerprint',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='stripe_checkout_url',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -1,16 +1,52 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.core.cache import cache
+from django.utils import timezone
+from django.db.models import Q
+from django.contrib.postgres.indexes import GinIndex
 from django.core.exceptions import ValidationError
+from collections import defaultdict
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+import base64
+import binascii
+import hashlib
+import time
 import uuid
+import zlib
 
 # Create your models here.
 
 
 class WebhookLog(models.Model):
-    received_at = models.DateTimeField(auto_now_add=True)
-    data = models.TextField(null=True, blank=True)
+    """
+    Audit log of inbound webhook payloads. Written in batches from a Redis buffer
+    (api.webhook_log). On PostgreSQL the table is range-partitioned by month on
+    received_at (primary key (id, received_at)), and old partitions are dropped by
+    the prune_webhook_logs task.
+    """
+    SOURCE_CHOICES = [
+        ("ghl_invoice", "GHL invoice"),
+        ("ghl_user", "GHL user"),
+        ("ghl_payroll", "GHL payroll"),
+        ("ghl_invoice_paid", "GHL invoice paid"),
+        ("stripe", "Stripe"),
+        ("legacy", "Legacy (before source was recorded)"),
+    ]
+
+    received_at = models.DateTimeField(default=timezone.now)
+    source = models.CharField(max_length=50, choices=SOURCE_CHOICES)
+    event_type = models.CharField(max_length=100, null=True, blank=True)
+    data = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'event_type', 'received_at']),
+            models.Index(fields=['received_at']),
+        ]
 
     def __str__(self):
-        return f"{self.webhook_id} : {self.received_at}"
+        return f"{self.source} {self.event_type} : {self.received_at}"
 
 
 class Service(models.Model):
@@ -54,7 +90,79 @@ class Contact(models.Model):
 
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.email})"
-    
+
+
+def normalize_search_term(value):
+    """Lowercase and collapse whitespace, the form search terms and search columns are compared in"""
+    return " ".join(str(value or "").lower().split())
+
+
+def normalize_contact_search(*values):
+    """Search text for a contact; values containing digits (phone numbers) are also indexed digits-only"""
+    parts = []
+    for value in values:
+        value = normalize_search_term(value)
+        if not value:
+            continue
+        parts.append(value)
+        digits = "".join(ch for ch in value if ch.isdigit())
+        if digits and digits != value:
+            parts.append(digits)
+    return " ".join(parts)
+
+
+class ContactSearchEntry(models.Model):
+    """
+    Local, indexed copy of the external contacts table used by the contact search.
+    Synced incrementally from data_management_app_contact by its `timestamp` column
+    (api.tasks.sync_contact_search). `search_text` has a trigram GIN index so
+    `search_text LIKE '%term%'` does not scan the table.
+    """
+    external_id = models.BigIntegerField(unique=True)
+    contact_id = models.CharField(max_length=100, unique=True)
+    first_name = models.CharField(max_length=100, blank=True, null=True)
+    last_name = models.CharField(max_length=100, blank=True, null=True)
+    phone = models.CharField(max_length=15, blank=True, null=True)
+    email = models.EmailField(blank=True, null=True)
+    dnd = models.BooleanField(default=False)
+    country = models.CharField(max_length=50, blank=True, null=True)
+    date_added = models.DateTimeField(blank=True, null=True)
+    tags = models.JSONField(default=list, blank=True)
+    custom_fields = models.JSONField(default=list, blank=True)
+    location_id = models.CharField(max_length=100)
+    timestamp = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    search_text = models.TextField(blank=True, default="")
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_text'], name='contact_search_text_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
+    def __str__(self):
+        return f"{self.first_name} {self.last_name} ({self.email})"
+
+    @classmethod
+    def from_contact(cls, contact):
+        return cls(
+            external_id=contact.id,
+            contact_id=contact.contact_id,
+            first_name=contact.first_name,
+            last_name=contact.last_name,
+            phone=contact.phone,
+            email=contact.email,
+            dnd=contact.dnd,
+            country=contact.country,
+            date_added=contact.date_added,
+            tags=contact.tags,
+            custom_fields=contact.custom_fields,
+            location_id=contact.location_id,
+            timestamp=contact.timestamp,
+            search_text=normalize_contact_search(contact.first_name, contact.last_name, contact.email, contact.phone),
+        )
+
+
 class Job(models.Model):
     contact_id = models.CharField(max_length=100)
     pipeline_id = models.CharField(max_length=100)
@@ -88,10 +196,140 @@ class Payout(models.Model):
     amount = models.DecimalField(decimal_places=2, max_digits=5)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['opportunity_id', 'user'], name='unique_payout_per_opportunity_user'),
+        ]
+
     def __str__(self):
         return f"{self.user.name} - ₹{self.amount:.2f} (Opportunity: {self.opportunity_id})"
 
 
+class PayoutDailyRollup(models.Model):
+    """Per-user payout totals for one America/Chicago calendar day, kept in step with Payout inserts"""
+    user = models.ForeignKey("ghl_auth.GHLUser", on_delete=models.CASCADE, related_name="payout_rollups")
+    day = models.DateField()
+    total = models.DecimalField(decimal_places=2, max_digits=12, default=0)
+    payout_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_payout_rollup_per_user_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.day}: {self.total} ({self.payout_count} payouts)"
+
+    @classmethod
+    def record(cls, payouts):
+        """
+        Add newly created payouts to their users' daily rollups in a constant number of queries.
+        Call it in the same transaction that created the payouts; if a concurrent transaction
+        creates one of the same rollup rows first, IntegrityError is raised and the caller retries.
+        """
+        chicago_tz = ZoneInfo("America/Chicago")
+        groups = defaultdict(lambda: [Decimal("0"), 0])
+        for payout in payouts:
+            key = (payout.user_id, payout.created_at.astimezone(chicago_tz).date())
+            # Rounded the way the 2-decimal amount column stores it
+            groups[key][0] += Decimal(str(payout.amount)).quantize(Decimal("0.01"))
+            groups[key][1] += 1
+        if not groups:
+            return
+
+        keys = Q()
+        for user_id, day in groups:
+            keys |= Q(user_id=user_id, day=day)
+        existing = {(rollup.user_id, rollup.day): rollup for rollup in cls.objects.select_for_update().filter(keys)}
+
+        for key, rollup in existing.items():
+            rollup.total += groups[key][0]
+            rollup.payout_count += groups[key][1]
+        cls.objects.bulk_update(existing.values(), ["total", "payout_count"])
+        cls.objects.bulk_create([
+            cls(user_id=user_id, day=day, total=total, payout_count=count)
+            for (user_id, day), (total, count) in groups.items()
+            if (user_id, day) not in existing
+        ])
+
+
+class GHLProduct(models.Model):
+    """Local cache of GHL product ids, keyed by location and normalized product name"""
+    location_id = models.CharField(max_length=100)
+    normalized_name = models.CharField(max_length=500)
+    name = models.CharField(max_length=500)
+
+    product_id = models.CharField(max_length=100, null=True, blank=True)
+    price_id = models.CharField(max_length=100, null=True, blank=True)
+    # When product_id was last confirmed against GHL; entries older than PRODUCT_CACHE_TTL are re-resolved
+    resolved_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['location_id', 'normalized_name'], name='unique_ghl_product_per_location'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.product_id})"
+
+
+def public_invoice_version_key(token):
+    return f"public_invoice:{token}:version"
+
+
+def public_invoice_version(token):
+    """Current cache version of an invoice's public payload; bumped by every invalidation"""
+    key = public_invoice_version_key(token)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock, not 1, so an evicted version key never revives old entries
+        cache.add(key, time.time_ns(), settings.PUBLIC_INVOICE_CACHE_TTL)
+        version = cache.get(key)
+    return version
+
+
+def public_invoice_cache_key(token, version):
+    return f"public_invoice:{token}:{version}"
+
+
+def invalidate_public_invoice(token):
+    """
+    Retire the cached public invoice payload once the current transaction commits, by
+    bumping its version. A reader that loaded the row before the commit stores its
+    payload under the old version, which nobody reads any more.
+    """
+    def bump():
+        key = public_invoice_version_key(token)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), settings.PUBLIC_INVOICE_CACHE_TTL)
+
+    transaction.on_commit(bump)
+
+
+class InvoiceQuerySet(models.QuerySet):
+    """Named lean querysets for the hot invoice paths; none of them load raw_data (the full GHL response)"""
+
+    # Columns read by the payment paths: Stripe checkout / verification / webhooks and the GHL paid webhook
+    PAYMENT_FIELDS = (
+        "id", "token", "ghl_invoice_id", "invoice_number", "name", "status", "currency",
+        "total", "amount_paid", "amount_due", "contact_id", "contact_name", "contact_email",
+        "location_id", "job_id", "tip_amount", "tip_notes",
+        "stripe_payment_intent_id", "stripe_checkout_session_id", "stripe_checkout_url",
+        "stripe_checkout_fingerprint", "stripe_checkout_expires_at", "payment_state", "signed_at", "updated_at",
+    )
+
+    def without_raw_data(self):
+        return self.defer("raw_data")
+
+    def for_payment(self):
+        return self.only(*self.PAYMENT_FIELDS)
+
+
 class Invoice(models.Model):
     """Model to store invoice data for public viewing"""
     STATUS_CHOICES = [
@@ -159,13 +397,30 @@ class Invoice(models.Model):
     tip_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     tip_notes = models.TextField(null=True, blank=True)
 
-    # Stripe payment tracking
+    # Stripe payment tracking. payment_state is fed by the Stripe webhook (and verification),
+    # so the payment page can wait on it locally instead of polling Stripe
+    PAYMENT_STATE_CHOICES = [
+        ("unpaid", "Unpaid"),
+        ("processing", "Processing"),
+        ("paid", "Paid"),
+        ("failed", "Failed"),
+        ("expired", "Expired"),
+    ]
+    payment_state = models.CharField(max_length=20, choices=PAYMENT_STATE_CHOICES, default="unpaid")
     stripe_payment_intent_id = models.CharField(max_length=200, null=True, blank=True)
     stripe_checkout_session_id = models.CharField(max_length=200, null=True, blank=True)
+    # The open checkout session is reused while its fingerprint (amounts, currency, tip) matches and it has not expired
+    stripe_checkout_url = models.TextField(null=True, blank=True)
+    stripe_checkout_fingerprint = models.CharField(max_length=64, null=True, blank=True)
+    stripe_checkout_expires_at = models.DateTimeField(null=True, blank=True)
     
-    # Digital signature (stored as base64 image)
-    signature = models.TextField(null=True, blank=True)
+    # Digital signature: the image itself lives in InvoiceSignature so invoice reads stay small
     signed_at = models.DateTimeField(null=True, blank=True)
+
+    objects = InvoiceQuerySet.as_manager()
+
+    # Fields written when a payment is recorded (save(update_fields=...))
+    PAYMENT_UPDATE_FIELDS = ["status", "payment_state", "amount_paid", "amount_due", "stripe_payment_intent_id", "tip_amount", "tip_notes", "updated_at"]
     
     class Meta:
         ordering = ['-created_at']
@@ -173,10 +428,21 @@ class Invoice(models.Model):
             models.Index(fields=['token']),
             models.Index(fields=['ghl_invoice_id']),
             models.Index(fields=['invoice_number']),
+            models.Index(fields=['stripe_checkout_session_id']),
+            models.Index(fields=['stripe_payment_intent_id']),
         ]
     
     def __str__(self):
         return f"Invoice {self.invoice_number or self.token} - {self.contact_name}"
+
+    # Queryset .update() / bulk writes bypass these; call invalidate_public_invoice() after them
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_public_invoice(self.token)
+
+    def delete(self, *args, **kwargs):
+        invalidate_public_invoice(self.token)
+        return super().delete(*args, **kwargs)
     
     @property
     def is_paid(self):
@@ -213,4 +479,174 @@ class InvoiceItem(models.Model):
         ordering = ['id']
     
     def __str__(self):
-        return f"{self.name} - {self.amount} {self.currency}"
\ No newline at end of file
+        return f"{self.name} - {self.amount} {self.currency}"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_public_invoice(self.invoice.token)
+
+    def delete(self, *args, **kwargs):
+        invalidate_public_invoice(self.invoice.token)
+        return super().delete(*args, **kwargs)
+
+
+class InvoiceSignature(models.Model):
+    """Signature image for an invoice, decoded from the submitted data URL and stored zlib-compressed"""
+    # The only types accepted and served, with the leading bytes every such image starts with
+    IMAGE_MAGIC = {
+        "image/png": b"\x89PNG\r\n\x1a\n",
+        "image/jpeg": b"\xff\xd8\xff",
+    }
+
+    invoice = models.OneToOneField(Invoice, on_delete=models.CASCADE, related_name="signature_image")
+    content_type = models.CharField(max_length=100, default="image/png")
+    data = models.BinaryField()
+    # sha256 of the decoded image; versions the public URL and is the ETag
+    digest = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Signature for {self.invoice_id} ({self.content_type})"
+
+    @staticmethod
+    def decode_data_url(value):
+        """
+        Split a "data:image/png;base64,..." string (or bare base64) into (content_type, bytes).
+        Only PNG and JPEG images are accepted, and the bytes must match the type.
+
+        Raises:
+            ValueError: When the value is not valid base64 or not a PNG / JPEG image
+        """
+        content_type = None
+        if value.startswith("data:"):
+            header, _, value = value.partition(",")
+            content_type = header[len("data:"):].split(";")[0].strip().lower()
+            if content_type not in InvoiceSignature.IMAGE_MAGIC:
+                raise ValueError("Signature must be a PNG or JPEG image")
+        try:
+            image = base64.b64decode(value, validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"Invalid signature data: {e}")
+
+        detected = InvoiceSignature.detect_content_type(image)
+        if detected is None or (content_type and content_type != detected):
+            raise ValueError("Signature must be a PNG or JPEG image")
+        return detected, image
+
+    @staticmethod
+    def detect_content_type(image):
+        """Content type of a PNG / JPEG image from its leading bytes, or None"""
+        for content_type, magic in InvoiceSignature.IMAGE_MAGIC.items():
+            if image.startswith(magic):
+                return content_type
+        return None
+
+    @property
+    def is_servable(self):
+        """False for rows whose type is not an accepted image (e.g. text kept by migration 0021)"""
+        return self.content_type in self.IMAGE_MAGIC
+
+    def set_image(self, content_type, image):
+        self.content_type = content_type
+        self.data = zlib.compress(image)
+        self.digest = hashlib.sha256(image).hexdigest()
+
+    @property
+    def image(self):
+        return zlib.decompress(self.data)
+
+
+class InvoicePaymentStep(models.Model):
+    """
+    One post-payment side effect for a paid invoice (GHL payment record, invoice_paid tag,
+    Service Pilot tip webhook). Run by Celery tasks with retries; one row per invoice and step
+    so a step is never queued twice, whichever path (Stripe webhook / verification) saw the payment.
+    """
+    STEP_CHOICES = [
+        ("ghl_payment", "Record payment in GHL"),
+        ("ghl_paid_tag", "Add invoice_paid tag"),
+        ("tip_webhook", "Service Pilot tip webhook"),
+    ]
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("retrying", "Retrying"),
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+    ]
+
+    invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name="payment_steps")
+    step = models.CharField(max_length=20, choices=STEP_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['invoice', 'step'], name='unique_invoice_payment_step'),
+        ]
+
+    def __str__(self):
+        return f"{self.invoice_id} {self.step} - {self.status}"
+
+
+class InvoiceWebhookRequest(models.Model):
+    """Invoice webhook accepted for background processing (async webhook mode)"""
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("processing", "Processing"),
+        ("created", "Created"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+    ]
+
+    # Pre-minted token; becomes Invoice.token once the GHL invoice is saved
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="queued")
+
+    invoice = models.ForeignKey(Invoice, on_delete=models.SET_NULL, null=True, blank=True, related_name="webhook_requests")
+    ghl_invoice_id = models.CharField(max_length=100, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Webhook request {self.token} - {self.status}"
+
+
+class WebhookDelivery(models.Model):
+    """
+    Idempotency record for an inbound webhook delivery, keyed by (endpoint, key) where the
+    key is the provider's event id or a hash of the payload. The first delivery claims the
+    row; duplicates inside the endpoint's window get the stored response back.
+    """
+    STATUS_CHOICES = [
+        ("processing", "Processing"),
+        ("done", "Done"),
+    ]
+
+    endpoint = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="processing")
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Duplicates are answered from this record until then
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['endpoint', 'key'], name='unique_webhook_delivery'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} {self.key} - {self.status}"
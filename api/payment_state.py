@@ -0,0 +1,202 @@
+"""
+Locally recorded Stripe payment state for invoices.
+
+The Stripe webhook (and payment verification) writes Invoice.payment_state and
+publishes the new state on a per-invoice Redis channel once the transaction commits.
+The payment page long-polls InvoicePaymentStatusView, which waits on that channel
+and only reads the invoice again when something was published, so a customer
+waiting on the success page costs no Stripe calls. Stripe is asked directly only
+when the wait times out, and at most once per PAYMENT_STATUS_STRIPE_FALLBACK_INTERVAL
+per invoice, to cover a webhook that is late or never arrives.
+"""
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Invoice
+from .tasks import queue_payment_steps
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "invoice_payment:"
+FALLBACK_KEY_PREFIX = "invoice_payment:stripe_check:"
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.PAYMENT_STATUS_REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    return _client
+
+
+def channel(token):
+    return f"{CHANNEL_PREFIX}{token}"
+
+
+def publish(invoice):
+    """Announce the invoice's payment state to waiting pollers once the transaction commits"""
+    token, state = str(invoice.token), invoice.payment_state
+
+    def send():
+        try:
+            get_redis().publish(channel(token), state)
+        except redis.RedisError as e:
+            # Pollers fall back to re-reading the invoice on their poll interval
+            logger.warning(f"Could not publish payment state for invoice {token}: {e}")
+
+    transaction.on_commit(send)
+
+
+def mark_paid(lookup, payment_intent_id=None, amount_total=None, metadata=None):
+    """
+    Record a successful Stripe payment and queue the post-payment side effects.
+
+    Args:
+        lookup (dict): Filter identifying the invoice (pk or stripe_checkout_session_id)
+        payment_intent_id (str, optional): Stripe PaymentIntent id
+        amount_total (int, optional): Amount charged in cents (invoice amount plus any tip)
+        metadata (dict, optional): Checkout session metadata (tip_amount, tip_notes)
+
+    Returns:
+        tuple: (Invoice, list of queued steps, was_already_paid)
+
+    Raises:
+        Invoice.DoesNotExist: When no invoice matches lookup
+    """
+    metadata = metadata or {}
+    tip_amount_str = metadata.get('tip_amount')
+    tip_notes = metadata.get('tip_notes') or 'Customer tip from payment'
+    try:
+        tip_amount_val = float(tip_amount_str) if tip_amount_str else None
+    except (TypeError, ValueError):
+        tip_amount_val = None
+
+    with transaction.atomic():
+        invoice = Invoice.objects.for_payment().select_for_update().get(**lookup)
+
+        if payment_intent_id:
+            invoice.stripe_payment_intent_id = payment_intent_id
+
+        # Amount paid may include the tip; GHL gets the invoice amount only
+        amount_paid = float(amount_total or 0) / 100
+
+        # An invoice already paid (webhook and verification racing) must not be recorded in GHL twice
+        was_already_paid = invoice.is_paid
+        ghl_amount = float(invoice.amount_due)
+
+        invoice.status = 'paid'
+        invoice.payment_state = 'paid'
+        invoice.amount_paid = amount_paid
+        invoice.amount_due = max(0, float(invoice.total) - amount_paid)
+        if tip_amount_val is not None:
+            invoice.tip_amount = tip_amount_val
+            invoice.tip_notes = tip_notes or None
+        invoice.save(update_fields=Invoice.PAYMENT_UPDATE_FIELDS)
+
+        queued = queue_payment_steps(
+            invoice,
+            ghl_amount=None if was_already_paid else ghl_amount,
+            tip_amount=tip_amount_val,
+            tip_notes=tip_notes,
+        )
+        publish(invoice)
+
+    return invoice, queued, was_already_paid
+
+
+def set_state(lookup, state):
+    """
+    Record a non-paid payment state (processing, failed, expired). A paid invoice is
+    never moved back. The stored checkout session is forgotten: in each of these states it
+    is complete or expired, so CreateStripeCheckoutSession must not hand it out again.
+
+    Returns:
+        Invoice: The updated invoice, or None when no unpaid invoice matches lookup
+    """
+    with transaction.atomic():
+        invoice = Invoice.objects.for_payment().select_for_update().filter(**lookup).first()
+        if invoice is None or invoice.is_paid or invoice.payment_state == state:
+            return invoice
+        invoice.payment_state = state
+        invoice.stripe_checkout_url = None
+        invoice.stripe_checkout_fingerprint = None
+        invoice.save(update_fields=["payment_state", "stripe_checkout_url", "stripe_checkout_fingerprint", "updated_at"])
+        publish(invoice)
+    return invoice
+
+
+def wait_for_change(token, since, timeout):
+    """
+    Block until the invoice's payment state differs from `since`, or `timeout` seconds pass.
+
+    Returns:
+        Invoice: The invoice as last read (for_payment fields)
+
+    Raises:
+        Invoice.DoesNotExist: When no invoice has this token
+    """
+    deadline = time.monotonic() + timeout
+    pubsub = None
+    try:
+        # Subscribe before the first read so a state published in between is not missed
+        pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel(token))
+    except redis.RedisError as e:
+        logger.warning(f"Payment state channel unavailable ({e}); polling the database")
+        pubsub = None
+
+    try:
+        while True:
+            invoice = Invoice.objects.for_payment().get(token=token)
+            remaining = deadline - time.monotonic()
+            if invoice.payment_state != since or remaining <= 0:
+                return invoice
+
+            wait = min(remaining, settings.PAYMENT_STATUS_POLL_INTERVAL)
+            if pubsub is None:
+                time.sleep(wait)
+                continue
+            try:
+                # Returns early when a state is published; the loop re-reads the invoice either way
+                pubsub.get_message(timeout=wait)
+            except redis.RedisError as e:
+                logger.warning(f"Payment state channel lost ({e}); polling the database")
+                pubsub = None
+    finally:
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except redis.RedisError:
+                pass
+
+
+def stripe_fallback_allowed(token):
+    """True at most once per PAYMENT_STATUS_STRIPE_FALLBACK_INTERVAL for an invoice"""
+    return cache.add(f"{FALLBACK_KEY_PREFIX}{token}", 1, settings.PAYMENT_STATUS_STRIPE_FALLBACK_INTERVAL)
+
+
+def sync_from_session(invoice, session):
+    """
+    Apply a retrieved Stripe checkout session to the invoice (the webhook fallback).
+
+    Returns:
+        Invoice: The invoice after the update
+    """
+    if session.payment_status == 'paid':
+        invoice, _, _ = mark_paid(
+            {"pk": invoice.pk},
+            payment_intent_id=session.payment_intent,
+            amount_total=session.amount_total,
+            metadata=getattr(session, 'metadata', None) or {},
+        )
+        return invoice
+
+    if getattr(session, 'status', None) == 'expired':
+        return set_state({"pk": invoice.pk}, "expired") or invoice
+    return invoice
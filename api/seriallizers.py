@@ -1,13 +1,235 @@
 from rest_framework import serializers
 
-from .models import Service, Contact, Job, Payout
+from .models import Service, Contact, ContactSearchEntry, Job, Payout, Invoice, InvoiceSignature, public_invoice_cache_key, public_invoice_version
 from ghl_auth.models import GHLUser, CommissionRule
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from pytz import timezone, UTC
 from django.utils.timezone import localtime
+from django.db.models import Q, Sum, Prefetch
+from django.conf import settings
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils.http import quote_etag
+import hashlib
+import json
 
 
+def payout_date_bounds(start_date, end_date):
+    """
+    Convert naive America/Chicago start/end dates (ISO strings) into UTC datetimes.
+    The end date is inclusive (up to 23:59:59.999999). Invalid or missing values give None.
+    """
+    chicago_tz = timezone("America/Chicago")
+    start = end = None
+
+    if start_date:
+        try:
+            start = datetime.fromisoformat(start_date)
+            # Convert from naive → Chicago time → UTC
+            start = chicago_tz.localize(start).astimezone(UTC)
+        except ValueError:
+            start = None
+
+    if end_date:
+        try:
+            end = datetime.fromisoformat(end_date)
+            end = end + timedelta(days=1) - timedelta(microseconds=1)
+            end = chicago_tz.localize(end).astimezone(UTC)
+        except ValueError:
+            end = None
+
+    return start, end
+
+
+def payout_date_filter(start_date, end_date, prefix=""):
+    """Q object limiting payouts to the date range; `prefix` is e.g. "payouts__" when filtering users."""
+    start, end = payout_date_bounds(start_date, end_date)
+    q = Q()
+    if start:
+        q &= Q(**{f"{prefix}created_at__gte": start})
+    if end:
+        q &= Q(**{f"{prefix}created_at__lte": end})
+    return q
+
+
+def payout_rollup_filter(start_date, end_date, prefix=""):
+    """
+    Q object limiting PayoutDailyRollup rows to the date range, or None when a bound carries
+    a time of day (rollups are per Chicago day, so those ranges must sum the payouts instead).
+    Invalid bounds are ignored, as in payout_date_bounds.
+    """
+    q = Q()
+    for value, lookup in ((start_date, "gte"), (end_date, "lte")):
+        if not value:
+            continue
+        try:
+            day = date.fromisoformat(value)
+        except ValueError:
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                continue
+            return None
+        q &= Q(**{f"{prefix}day__{lookup}": day})
+    return q
+
+
+
+def validate_commission_rules(assigned_to_ids):
+    """
+    Check that every assigned user has a commission for this team size: a CommissionRule
+    for `len(assigned_to_ids) - 1` other employees, or their flat percentage when working alone.
+    Users and their matching rules are loaded together (two queries in total) and every
+    failure is reported, not just the first.
+
+    Returns:
+        list: One dict per assigned id, in order, with keys
+            user_id, valid, message (summary for the validations screen) and error (None when valid)
+    """
+    num_other_employees = len(assigned_to_ids) - 1
+    users = GHLUser.objects.filter(user_id__in=assigned_to_ids).prefetch_related(
+        Prefetch(
+            "commission_rules",
+            queryset=CommissionRule.objects.filter(num_other_employees=num_other_employees),
+            to_attr="matching_rules",
+        )
+    )
+    users_by_id = {user.user_id: user for user in users}
+
+    results = []
+    for user_id in assigned_to_ids:
+        user = users_by_id.get(user_id)
+        if not user:
+            message = f"User with ID {user_id} not found."
+            results.append({"user_id": user_id, "valid": False, "message": message, "error": message})
+            continue
+
+        rule = user.matching_rules[0] if user.matching_rules else None
+        if rule:
+            results.append({
+                "user_id": user_id,
+                "valid": True,
+                "message": f"{rule.commission_percentage}% for {user.first_name} (working with {num_other_employees} other(s)).",
+                "error": None,
+            })
+        elif num_other_employees == 0 and user.percentage is not None:
+            results.append({
+                "user_id": user_id,
+                "valid": True,
+                "message": f"{user.percentage}% for {user.first_name} (working alone).",
+                "error": None,
+            })
+        else:
+            results.append({
+                "user_id": user_id,
+                "valid": False,
+                "message": f"No commission rule for {user.first_name} (working with {num_other_employees} other(s)).",
+                "error": f"No commission rule for user {user.first_name} {user.last_name} when working with {num_other_employees} other(s).",
+            })
+    return results
+
+
+def public_invoice_queryset():
+    """Invoices with items and signature metadata loaded, but not the signature image itself"""
+    return (
+        Invoice.objects.without_raw_data()
+        .select_related('signature_image')
+        .defer('signature_image__data')
+        .prefetch_related('items')
+    )
+
+
+def signature_reference(invoice, signature=None):
+    """Path of the invoice's signature image, versioned by its digest so it can be cached forever; None when unsigned"""
+    if signature is None:
+        try:
+            signature = invoice.signature_image
+        except InvoiceSignature.DoesNotExist:
+            return None
+    if not signature.is_servable:
+        return None
+    path = reverse("invoice-signature-image", kwargs={"token": invoice.token})
+    return f"{path}?v={signature.digest[:16]}"
+
+
+def public_invoice_data(invoice):
+    """Public invoice page payload (invoice + line items)"""
+    return {
+        "token": str(invoice.token),
+        "invoice_number": invoice.invoice_number,
+        "name": invoice.name,
+        "status": invoice.status,
+        "currency": invoice.currency,
+        "total": str(invoice.total),
+        "invoice_total": str(invoice.invoice_total) if invoice.invoice_total else None,
+        "amount_paid": str(invoice.amount_paid),
+        "amount_due": str(invoice.amount_due),
+        "discount_value": str(invoice.discount_value) if invoice.discount_value is not None else None,
+        "discount_type": invoice.discount_type,
+        "is_paid": invoice.is_paid,
+        "issue_date": invoice.issue_date.isoformat() if invoice.issue_date else None,
+        "due_date": invoice.due_date.isoformat() if invoice.due_date else None,
+        "contact": {
+            "name": invoice.contact_name,
+            "email": invoice.contact_email,
+            "phone": invoice.contact_phone,
+            "address": invoice.contact_address,
+            "company_name": invoice.contact_company_name,
+        },
+        "business": {
+            "name": invoice.business_name,
+            "logo_url": invoice.business_logo_url,
+        },
+        "location_id": invoice.location_id,
+        "items": [
+            {
+                "name": item.name,
+                "description": item.description,
+                "quantity": str(item.quantity),
+                "amount": str(item.amount),
+                "currency": item.currency,
+                "taxes": item.taxes,
+                "tax_inclusive": item.tax_inclusive,
+            }
+            for item in invoice.items.all()
+        ],
+        "created_at": invoice.created_at.isoformat() if invoice.created_at else None,
+        "sent_at": invoice.sent_at.isoformat() if invoice.sent_at else None,
+        "signature": signature_reference(invoice),
+        "signed_at": invoice.signed_at.isoformat() if invoice.signed_at else None,
+        "tip_amount": str(invoice.tip_amount) if invoice.tip_amount is not None and invoice.tip_amount > 0 else None,
+        "tip_notes": invoice.tip_notes or None,
+    }
+
+
+def cache_public_invoice(invoice, version):
+    """
+    Build the public payload for `invoice` and store it under (token, version) with an ETag
+    of the payload. `version` must be read before the invoice was loaded, so a row read
+    before a concurrent save commits is stored under the version that save retires.
+    """
+    data = public_invoice_data(invoice)
+    entry = {
+        "etag": quote_etag(hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()),
+        "data": data,
+    }
+    cache.set(public_invoice_cache_key(invoice.token, version), entry, settings.PUBLIC_INVOICE_CACHE_TTL)
+    return entry
+
+
+def get_public_invoice(token):
+    """Cached public invoice entry ({"etag", "data"}), or None when the invoice does not exist"""
+    version = public_invoice_version(token)
+    entry = cache.get(public_invoice_cache_key(token, version))
+    if entry is None:
+        try:
+            invoice = public_invoice_queryset().get(token=token)
+        except Invoice.DoesNotExist:
+            return None
+        entry = cache_public_invoice(invoice, version)
+    return entry
+
 
 class ServiceSerializer(serializers.ModelSerializer):
     class Meta:
@@ -19,6 +241,14 @@ class ContactSerializer(serializers.ModelSerializer):
         model = Contact
         fields = '__all__'
 
+class ContactSearchEntrySerializer(serializers.ModelSerializer):
+    """Same shape as ContactSerializer; `id` is the contact's id in the external table"""
+    id = serializers.IntegerField(source='external_id', read_only=True)
+
+    class Meta:
+        model = ContactSearchEntry
+        exclude = ['external_id', 'search_text', 'synced_at']
+
 class JobSerializer(serializers.ModelSerializer):
     class Meta:
         model = Job
@@ -41,7 +271,7 @@ class JobSerializer(serializers.ModelSerializer):
 class GHLUserSerializer(serializers.ModelSerializer):
     class Meta:
         model = GHLUser
-        fields = "__all__"
+        exclude = ["search_text"]
 
 
 class GHLUserPercentageEditSerializer(serializers.ModelSerializer):
@@ -80,33 +310,20 @@ class PayrollSerializer(serializers.ModelSerializer):
         fields = ["user_id", "name", "email", "percentage", "total_payout", "payouts", "commission_rules"]
 
     def get_filtered_payouts(self, obj):
-        payouts = obj.payouts.all()
-        chicago_tz = timezone("America/Chicago")
-
-        start_date = self.context.get("start_date")
-        end_date = self.context.get("end_date")
-
-        if start_date:
-            try:
-                start_date = datetime.fromisoformat(start_date)
-                # Convert from naive → Chicago time → UTC
-                start_date = chicago_tz.localize(start_date).astimezone(UTC)
-                payouts = payouts.filter(created_at__gte=start_date)
-            except ValueError:
-                pass
-
-        if end_date:
-            try:
-                end_date = datetime.fromisoformat(end_date)
-                end_date = end_date + timedelta(days=1) - timedelta(microseconds=1)
-                end_date = chicago_tz.localize(end_date).astimezone(UTC)
-                payouts = payouts.filter(created_at__lte=end_date)
-            except ValueError:
-                pass
-
-        return payouts
+        # PayrollView prefetches the date-filtered payouts into `filtered_payouts`
+        if hasattr(obj, "filtered_payouts"):
+            return obj.filtered_payouts
+        date_filter = payout_date_filter(self.context.get("start_date"), self.context.get("end_date"))
+        return obj.payouts.filter(date_filter)
 
     def get_total_payout(self, obj):
+        # PayrollView annotates the SQL-side Sum as `payout_total` (None when there are no payouts)
+        if hasattr(obj, "payout_total"):
+            return round(obj.payout_total, 2) if obj.payout_total is not None else 0
+        rollup_filter = payout_rollup_filter(self.context.get("start_date"), self.context.get("end_date"))
+        if rollup_filter is not None:
+            total = obj.payout_rollups.filter(rollup_filter).aggregate(total=Sum("total"))["total"]
+            return round(total, 2) if total is not None else 0
         payouts = self.get_filtered_payouts(obj)
         return round(sum(p.amount for p in payouts), 2)
 
@@ -0,0 +1,32 @@
+"""
+Process-wide Stripe client.
+
+One stripe.StripeClient is built from settings the first time it is needed and
+shared by every request, instead of assigning the module-global stripe.api_key per
+request. Its RequestsClient keeps a keep-alive session per worker thread, uses
+explicit connect/read timeouts, and Stripe's own retry logic (with idempotency keys
+on POSTs) handles transient network errors.
+"""
+import threading
+
+import stripe
+from django.conf import settings
+
+_lock = threading.Lock()
+_client = None
+
+
+def get_stripe_client():
+    """Return the shared StripeClient, creating it on first use"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+                    http_client=stripe.RequestsClient(
+                        timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+                    ),
+                )
+    return _client
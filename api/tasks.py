@@ -1,13 +1,23 @@
-import requests, logging
+import requests, logging, random
 from celery import shared_task
+from ghl_auth import registry
 from ghl_auth.models import GHLAuthCredentials
+from ghl_auth.oauth import refresh_access_token
+from ghl_auth.registry import get_credentials
+from ghl_auth.utils import invalidate_user_search_cache
 from django.conf import settings
+from django.db import connections, transaction, IntegrityError
+from django.db.models import Max
+from django.utils import timezone
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from api.utils import send_invoice, extract_invoice_id_from_name, fetch_opportunity_by_id, search_ghl_contact, create_invoice, update_contact, getBussiness
+from api.utils import send_invoice, extract_invoice_id_from_name, fetch_opportunity_by_id, search_ghl_contact, create_invoice, update_contact, getBussiness, fetch_products_page, normalize_product_name, record_payment_in_ghl, ghl_invoice_payment_recorded, add_invoice_paid_tag_to_contact, trigger_tip_webhook
 from ghl_auth.models import GHLUser, CommissionRule
-from .models import Payout, Invoice, InvoiceItem
+from .seriallizers import get_public_invoice
+from . import webhook_log
+from .models import Payout, PayoutDailyRollup, Invoice, InvoiceItem, InvoiceWebhookRequest, InvoicePaymentStep, WebhookDelivery, GHLProduct, Contact, ContactSearchEntry
 
 
 GHL_CLIENT_ID = settings.GHL_CLIENT_ID
@@ -48,90 +58,199 @@ logger = logging.getLogger(__name__)
 #         print(response, 'responseee', new_tokens)
 #         print("refreshed: ", obj)
 
+def _refresh_credentials(credentials):
+    # Runs on a pool thread: release the thread's DB connection when done
+    try:
+        refresh_access_token(credentials.pk, margin=settings.GHL_TOKEN_REFRESH_MARGIN)
+    except requests.RequestException as e:
+        logger.error(
+            f"Network error refreshing token for location {credentials.location_id}: {e}"
+        )
+    except Exception as e:
+        logger.error(
+            f"Unexpected error refreshing token for location {credentials.location_id}: {e}",
+            exc_info=True
+        )
+    finally:
+        connections.close_all()
+
+
 @shared_task
 def make_api_call():
-    """Refresh OAuth tokens for all GHL credentials"""
-    tokens = GHLAuthCredentials.objects.all()
-    
-    if not tokens.exists():
+    """Refresh, concurrently across locations, the GHL OAuth tokens that expire within GHL_TOKEN_REFRESH_MARGIN"""
+    tokens = list(GHLAuthCredentials.objects.all())
+
+    if not tokens:
         logger.warning("No GHL credentials found to refresh")
         return
 
-    for credentials in tokens:
-        try:
-            logger.info(f"Refreshing token for location: {credentials.location_id}")
-            refresh_token = credentials.refresh_token
-
-            # Make the refresh request
-            response = requests.post(
-                'https://services.leadconnectorhq.com/oauth/token',
-                data={
-                    'grant_type': 'refresh_token',
-                    'client_id': GHL_CLIENT_ID,
-                    'client_secret': GHL_CLIENT_SECRET,
-                    'refresh_token': refresh_token
-                },
-                timeout=10  # Add timeout
-            )
-            
-            # Check if request was successful
-            if response.status_code != 200:
-                logger.error(
-                    f"Token refresh failed for location {credentials.location_id}. "
-                    f"Status: {response.status_code}, Response: {response.text}"
-                )
-                continue
-            
-            # Parse response
-            new_tokens = response.json()
-            
-            # Validate response contains required fields
-            if 'access_token' not in new_tokens or 'refresh_token' not in new_tokens:
-                logger.error(
-                    f"Invalid token response for location {credentials.location_id}: "
-                    f"{new_tokens}"
-                )
+    due = [credentials for credentials in tokens if credentials.expires_within(settings.GHL_TOKEN_REFRESH_MARGIN)]
+    if not due:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(settings.GHL_TOKEN_REFRESH_WORKERS, len(due))) as executor:
+        list(executor.map(_refresh_credentials, due))
+
+
+PRODUCT_PAGE_SIZE = 100
+
+
+def sync_location_products(credentials):
+    """
+    Page through one location's GHL product list and upsert it into GHLProduct.
+    Rows for products that no longer exist in GHL are removed once the sync completes.
+
+    Returns:
+        int: Number of products synced
+    """
+    location_id = credentials.location_id
+    started_at = timezone.now()
+    synced = 0
+    offset = 0
+
+    while True:
+        products = fetch_products_page(credentials.access_token, location_id, offset, PRODUCT_PAGE_SIZE)
+
+        # GHL may return several products with the same name; keep the first, like the search does
+        rows = {}
+        for product in products:
+            name = product.get("name")
+            if not name or not product.get("_id"):
                 continue
-            
-            # Update credentials
-            obj, created = GHLAuthCredentials.objects.update_or_create(
-                location_id=new_tokens.get("locationId"),
-                defaults={
-                    "access_token": new_tokens.get("access_token"),
-                    "refresh_token": new_tokens.get("refresh_token"),
-                    "expires_in": new_tokens.get("expires_in"),
-                    "scope": new_tokens.get("scope"),
-                    "user_type": new_tokens.get("userType"),
-                    "company_id": new_tokens.get("companyId"),
-                    "user_id": new_tokens.get("userId"),
-                }
-            )
-            
-            action = "created" if created else "updated"
-            logger.info(
-                f"Successfully {action} credentials for location {obj.location_id}"
+            rows.setdefault(normalize_product_name(name), GHLProduct(
+                location_id=location_id,
+                normalized_name=normalize_product_name(name),
+                name=name,
+                product_id=product.get("_id"),
+                price_id=(product.get("prices") or [{}])[0].get("_id"),
+                resolved_at=timezone.now(),
+            ))
+
+        if rows:
+            GHLProduct.objects.bulk_create(
+                rows.values(),
+                update_conflicts=True,
+                unique_fields=["location_id", "normalized_name"],
+                update_fields=["name", "product_id", "price_id", "resolved_at"],
             )
+            synced += len(rows)
 
-            logger.info(
-                f"Status: {response.status_code}, Response: {response.text}"
-            )
-            
-        except requests.RequestException as e:
-            logger.error(
-                f"Network error refreshing token for location {credentials.location_id}: {e}"
-            )
+        if len(products) < PRODUCT_PAGE_SIZE:
+            break
+        offset += PRODUCT_PAGE_SIZE
+
+    # Anything not touched by this run is gone from GHL
+    GHLProduct.objects.filter(location_id=location_id, resolved_at__lt=started_at).delete()
+    GHLAuthCredentials.objects.filter(pk=credentials.pk).update(products_synced_at=timezone.now())
+    registry.invalidate()
+    return synced
+
+
+@shared_task
+def sync_product_catalog():
+    """Materialize every connected location's GHL product catalog into GHLProduct (runs off-peak from beat)"""
+    for credentials in registry.all_credentials():
+        if not credentials.location_id:
+            continue
+        try:
+            synced = sync_location_products(credentials)
+            logger.info(f"Synced {synced} products for location {credentials.location_id}")
         except Exception as e:
             logger.error(
-                f"Unexpected error refreshing token for location {credentials.location_id}: {e}",
+                f"Error syncing products for location {credentials.location_id}: {e}",
                 exc_info=True
             )
 
 
-def save_invoice_to_db(ghl_response, contact_id, contact_name, contact_email, contact_phone, contact_address, company_name, location_id, discount=None, job_id=None):
+@shared_task
+def flush_webhook_logs():
+    """Write buffered webhook payloads to WebhookLog in batches (runs every few seconds from beat)"""
+    written = webhook_log.flush()
+    if written:
+        logger.info(f"Flushed {written} webhook logs")
+    return written
+
+
+@shared_task
+def prune_webhook_logs():
+    """Create upcoming monthly WebhookLog partitions and drop logs past WEBHOOK_LOG_RETENTION_DAYS"""
+    webhook_log.ensure_partitions()
+    dropped = webhook_log.drop_expired()
+    logger.info(f"Pruned webhook logs; dropped partitions: {dropped}")
+    return dropped
+
+
+@shared_task
+def prune_webhook_deliveries():
+    """Delete webhook idempotency records whose dedup window has passed"""
+    deleted, _ = WebhookDelivery.objects.filter(expires_at__lt=timezone.now()).delete()
+    logger.info(f"Pruned {deleted} expired webhook deliveries")
+    return deleted
+
+
+CONTACT_SYNC_BATCH_SIZE = 1000
+# Re-read rows slightly older than the newest synced timestamp so writes that commit late on the external DB are not missed
+CONTACT_SYNC_OVERLAP = timedelta(minutes=5)
+CONTACT_SYNC_UPDATE_FIELDS = [
+    "external_id", "first_name", "last_name", "phone", "email", "dnd", "country", "date_added",
+    "tags", "custom_fields", "location_id", "timestamp", "search_text", "synced_at",
+]
+
+
+def _upsert_contact_entries(entries):
+    ContactSearchEntry.objects.bulk_create(
+        entries,
+        update_conflicts=True,
+        unique_fields=["contact_id"],
+        update_fields=CONTACT_SYNC_UPDATE_FIELDS,
+    )
+
+
+@shared_task
+def sync_contact_search(full=False):
+    """
+    Copy contacts from the external contacts table into ContactSearchEntry.
+
+    Incremental runs only read contacts whose `timestamp` is at or after the newest one
+    already mirrored (minus CONTACT_SYNC_OVERLAP). A full run re-reads everything and
+    removes mirror rows for contacts deleted from the external table.
+
+    Returns:
+        int: Number of contacts synced
+    """
+    started_at = timezone.now()
+    contacts = Contact.objects.using('external').order_by('timestamp', 'id')
+
+    watermark = None if full else ContactSearchEntry.objects.aggregate(latest=Max('timestamp'))['latest']
+    if watermark:
+        contacts = contacts.filter(timestamp__gte=watermark - CONTACT_SYNC_OVERLAP)
+
+    synced = 0
+    batch = []
+    for contact in contacts.iterator(chunk_size=CONTACT_SYNC_BATCH_SIZE):
+        batch.append(ContactSearchEntry.from_contact(contact))
+        if len(batch) >= CONTACT_SYNC_BATCH_SIZE:
+            _upsert_contact_entries(batch)
+            synced += len(batch)
+            batch = []
+    if batch:
+        _upsert_contact_entries(batch)
+        synced += len(batch)
+
+    if full:
+        deleted, _ = ContactSearchEntry.objects.filter(synced_at__lt=started_at).delete()
+        logger.info(f"Removed {deleted} deleted contacts from the search mirror")
+
+    logger.info(f"Synced {synced} contacts into the search mirror (full={full})")
+    return synced
+
+
+def save_invoice_to_db(ghl_response, contact_id, contact_name, contact_email, contact_phone, contact_address, company_name, location_id, discount=None, job_id=None, token=None):
     """
     Save invoice data from GHL response to database.
     discount (dict, optional): From webhook payload { "value": number, "type": "percentage"|"fixed" }.
     job_id (str, optional): Job UUID from webhook, used for tip webhook to Service Pilot.
+    token (UUID, optional): Pre-minted public token (async webhook mode), used only when the invoice is created.
     """
     try:
         # Parse dates
@@ -218,9 +337,11 @@ def save_invoice_to_db(ghl_response, contact_id, contact_name, contact_email, co
         }
         if job_id is not None:
             defaults["job_id"] = job_id
+        create_defaults = {**defaults, "token": token} if token else None
         invoice, created = Invoice.objects.update_or_create(
             ghl_invoice_id=ghl_response.get("_id"),
             defaults=defaults,
+            create_defaults=create_defaults,
         )
 
 
@@ -244,7 +365,7 @@ def save_invoice_to_db(ghl_response, contact_id, contact_name, contact_email, co
                     "taxes": item_data.get("taxes", []),
                 }
             )
-        
+
         return invoice
     except Exception as e:
         logger.error(f"Error saving invoice to database: {e}", exc_info=True)
@@ -252,7 +373,7 @@ def save_invoice_to_db(ghl_response, contact_id, contact_name, contact_email, co
 
 
 @shared_task
-def handle_webhook_event(data):
+def handle_webhook_event(data, token=None):
     try:
         customer_email = data.get("customer_email")
         customer_name = data.get("customer_name")
@@ -265,9 +386,11 @@ def handle_webhook_event(data):
             return {"error": "Customer email missing"}
 
         if location_id:
-            credentials = GHLAuthCredentials.objects.get(location_id=location_id)
+            credentials = get_credentials(location_id, fallback=False)
+            if not credentials:
+                return {"error": f"No GHL credentials found for location {location_id}"}
         else:
-            credentials = GHLAuthCredentials.objects.first()
+            credentials = get_credentials()
 
         # Search contact
         contacts = search_ghl_contact(credentials.access_token, customer_email, credentials.location_id)
@@ -327,7 +450,7 @@ def handle_webhook_event(data):
             if webhook_location_id == "b8qvo7VooP3JD3dIZU42":
                 try:
                     job_id = data.get("job_id")  # Job UUID for Service Pilot tip webhook
-                    saved_invoice = save_invoice_to_db(response, contact_id, contactName, contacts[0].get("email"), phoneNo, customer_address, companyName, webhook_location_id, discount=data.get("discount"), job_id=job_id)
+                    saved_invoice = save_invoice_to_db(response, contact_id, contactName, contacts[0].get("email"), phoneNo, customer_address, companyName, webhook_location_id, discount=data.get("discount"), job_id=job_id, token=token)
                     print(f"Invoice saved to database with token: {saved_invoice.token}")
                 except Exception as e:
                     print(f"Error saving invoice to database: {e}")
@@ -351,7 +474,7 @@ def handle_webhook_event(data):
                                 saved_invoice.sent_at = datetime.fromisoformat(sent_at_str.replace('Z', '+00:00'))
                             except:
                                 pass
-                        saved_invoice.save()
+                        saved_invoice.save(update_fields=["status", "sent_at", "updated_at"])
                 else:
                     print("Card authorized → skipping invoice send.")
                     send_resp = "skipped"
@@ -359,6 +482,11 @@ def handle_webhook_event(data):
                 print("Error sending invoice:", e)
                 send_resp = None
 
+            if saved_invoice:
+                # Warm the public invoice cache after the last save (each save drops the
+                # entry), so the customer's first page load is a cache hit
+                transaction.on_commit(lambda: get_public_invoice(saved_invoice.token))
+
             # Avoid duplicates
             updated_tags = list(set(existing_tags + ["Invoice Created"]))
             payload = {"tags": updated_tags}
@@ -432,6 +560,70 @@ def handle_webhook_event(data):
         traceback.print_exc()
         return {"error": str(e)}
 
+@shared_task
+def process_invoice_webhook_request(token):
+    """
+    Run handle_webhook_event for a webhook accepted in async mode and record
+    the outcome on its InvoiceWebhookRequest so the status endpoint can report it.
+    """
+    try:
+        webhook_request = InvoiceWebhookRequest.objects.get(token=token)
+    except InvoiceWebhookRequest.DoesNotExist:
+        logger.error(f"Invoice webhook request {token} not found")
+        return {"error": "Webhook request not found"}
+
+    webhook_request.status = "processing"
+    webhook_request.save(update_fields=["status", "updated_at"])
+
+    result = handle_webhook_event(webhook_request.payload, token=webhook_request.token)
+
+    if not result or result.get("error"):
+        webhook_request.status = "failed"
+        webhook_request.error = str((result or {}).get("error") or "Invoice was not created")
+        webhook_request.save(update_fields=["status", "error", "updated_at"])
+        return result
+
+    invoice_data = result.get("invoice") or {}
+    send_resp = result.get("invoice_send")
+    webhook_request.ghl_invoice_id = invoice_data.get("_id")
+    webhook_request.invoice = Invoice.objects.filter(token=webhook_request.token).only("id").first()
+    if isinstance(send_resp, dict) and not send_resp.get("error"):
+        webhook_request.status = "sent"
+    else:
+        webhook_request.status = "created"
+    webhook_request.save(update_fields=["status", "ghl_invoice_id", "invoice", "updated_at"])
+    return {"status": webhook_request.status, "invoice_token": str(webhook_request.token)}
+
+
+def save_payouts(opportunity_id, opportunity_name, payout_amounts):
+    """
+    Insert the missing payouts for an opportunity with one bulk_create, and update their
+    daily rollups, in a single transaction backed by the (opportunity_id, user) unique constraint.
+
+    Args:
+        payout_amounts (dict): GHLUser -> Decimal amount
+    """
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                payouts = Payout.objects.filter(opportunity_id=opportunity_id)
+                # Keep the stored name current when the opportunity is renamed
+                payouts.exclude(opportunity_name=opportunity_name).update(opportunity_name=opportunity_name)
+
+                existing_user_ids = set(payouts.values_list("user_id", flat=True))
+                new_payouts = Payout.objects.bulk_create([
+                    Payout(opportunity_id=opportunity_id, opportunity_name=opportunity_name, user=user, amount=amount)
+                    for user, amount in payout_amounts.items()
+                    if user.pk not in existing_user_ids
+                ])
+                PayoutDailyRollup.record(new_payouts)
+            return new_payouts
+        except IntegrityError:
+            # A concurrent delivery inserted some of these payouts first; retry against the new state
+            if attempt:
+                raise
+
+
 @shared_task
 def payroll_webhook_event(data):
     try:
@@ -454,57 +646,52 @@ def payroll_webhook_event(data):
                 break
         print(is_first_time, 'is_first', assignedTo)
 
-        try:
-            estimator = GHLUser.objects.get(user_id=assignedTo)
-            percentage = 15 if is_first_time else 2
-            payout_amount = (monetary_value * percentage) / Decimal("100.00")
-            payout_amount = payout_amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-            # Ensure unique payout per opportunity-user combo
-            Payout.objects.get_or_create(
-                opportunity_id=opportunity_id,
-                opportunity_name=opportunity_name,
-                user=estimator,
-                defaults={
-                    "amount": payout_amount
-                }
-            )
-        except GHLUser.DoesNotExist:
-            print(f"User with ID {assignedTo} for estimator does not exist.")
-        
         followers_count = len(follower_ids)
         print(followers_count, 'followers_count')
         num_other_employees = followers_count-1
         print(num_other_employees, 'num_other_employees')
 
+        # Estimator and followers in one query, their commission rules in a second
+        users = GHLUser.objects.in_bulk([assignedTo, *follower_ids], field_name="user_id")
+        rules = {
+            rule.ghl_user_id: rule
+            for rule in CommissionRule.objects.filter(
+                ghl_user__in=[user.pk for user in users.values()],
+                num_other_employees=num_other_employees,
+            )
+        }
+
+        # One payout per opportunity-user combo; the estimator payout wins if the estimator also follows
+        payout_amounts = {}
+
+        estimator = users.get(assignedTo)
+        if estimator:
+            percentage = 15 if is_first_time else 2
+            payout_amount = (monetary_value * percentage) / Decimal("100.00")
+            payout_amount = payout_amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            payout_amounts[estimator] = payout_amount
+        else:
+            print(f"User with ID {assignedTo} for estimator does not exist.")
+
         for follower_id in follower_ids:
-            try:
-                user = GHLUser.objects.get(user_id=follower_id)
-            except GHLUser.DoesNotExist:
+            user = users.get(follower_id)
+            if not user:
                 print(f"User with ID {follower_id} does not exist.")
                 continue
 
-            try:
-                if num_other_employees == 0:
-                    # Use flat_percentage stored in GHLUser
-                    payout_amount = (monetary_value * user.percentage) / Decimal("100.00")
-                    payout_amount = payout_amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                else:
-                    commission = CommissionRule.objects.get(ghl_user=user, num_other_employees=num_other_employees)
-                    payout_amount = (monetary_value * commission.commission_percentage) / Decimal("100.00")
-
-                # Ensure unique payout per opportunity-user combo
-                Payout.objects.get_or_create(
-                    opportunity_id=opportunity_id,
-                    opportunity_name=opportunity_name,
-                    user=user,
-                    defaults={
-                        "amount": payout_amount
-                    }
-                )
-            except CommissionRule.DoesNotExist:
-                print(f"commission not found for {follower_id} with {num_other_employees} other employees")
-                continue
+            if num_other_employees == 0:
+                # Use flat_percentage stored in GHLUser
+                payout_amount = (monetary_value * user.percentage) / Decimal("100.00")
+                payout_amount = payout_amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            else:
+                commission = rules.get(user.pk)
+                if not commission:
+                    print(f"commission not found for {follower_id} with {num_other_employees} other employees")
+                    continue
+                payout_amount = (monetary_value * commission.commission_percentage) / Decimal("100.00")
+            payout_amounts.setdefault(user, payout_amount)
+
+        save_payouts(opportunity_id, opportunity_name, payout_amounts)
     except Exception as e:
         print(f"Error handling webhook event: {str(e)}")
 
@@ -525,6 +712,122 @@ def handle_user_create_webhook_event(data, event_type):
                     "location_id": data.get("locationId"),
                 }
             )
+            invalidate_user_search_cache()
             print("User created/updated:", user_id)
     except Exception as e:
-        print(f"Error handling webhook event: {str(e)}")
\ No newline at end of file
+        print(f"Error handling webhook event: {str(e)}")
+
+def _payment_step_countdown(retries):
+    # Exponential backoff with jitter, capped at PAYMENT_STEP_BACKOFF_MAX seconds
+    delay = min(settings.PAYMENT_STEP_BACKOFF_MAX, settings.PAYMENT_STEP_BACKOFF_BASE * (2 ** retries))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _run_payment_step(task, invoice_id, step, action, idempotent=False, already_applied=None):
+    """
+    Run one post-payment step and record the outcome on its InvoicePaymentStep row.
+
+    `action(invoice)` returns the {"success": ..., "error": ...} dict the api.utils helpers return.
+    A failure is retried by Celery (until the task's max_retries, then marked failed) only when
+    repeating it cannot apply the step twice:
+      - idempotent steps retry every failure
+      - otherwise the result must be "retryable" (the request provably was not applied), or
+        "uncertain" with an `already_applied(invoice)` check, which runs before each retry and
+        returns True / False, or None when the remote state could not be read
+    """
+    payment_step = InvoicePaymentStep.objects.get(invoice_id=invoice_id, step=step)
+    if payment_step.status == "succeeded":
+        return {"success": True, "message": "Already done"}
+
+    invoice = Invoice.objects.for_payment().get(pk=invoice_id)
+    try:
+        applied = already_applied(invoice) if already_applied and payment_step.attempts else False
+        if applied:
+            result = {"success": True, "message": "Already applied by an earlier attempt"}
+        elif applied is None:
+            result = {"success": False, "error": "Could not check whether an earlier attempt was applied", "retryable": True}
+        else:
+            result = action(invoice)
+    except Exception as e:
+        logger.error(f"Payment step {step} for invoice {invoice_id} raised: {e}", exc_info=True)
+        result = {"success": False, "error": str(e), "uncertain": True}
+
+    payment_step.attempts += 1
+    if result.get("success"):
+        payment_step.status = "succeeded"
+        payment_step.last_error = None
+    else:
+        retryable = idempotent or result.get("retryable") or (result.get("uncertain") and already_applied is not None)
+        payment_step.status = "retrying" if retryable and task.request.retries < task.max_retries else "failed"
+        payment_step.last_error = str(result.get("error"))
+    payment_step.save(update_fields=["status", "attempts", "last_error", "updated_at"])
+
+    if payment_step.status == "retrying":
+        logger.warning(f"Payment step {step} for invoice {invoice_id} failed ({payment_step.last_error}); retrying")
+        raise task.retry(countdown=_payment_step_countdown(task.request.retries))
+    if payment_step.status == "failed":
+        logger.error(f"Payment step {step} for invoice {invoice_id} failed after {payment_step.attempts} attempts: {payment_step.last_error}")
+    return result
+
+
+@shared_task(bind=True, max_retries=5)
+def record_invoice_payment_in_ghl(self, invoice_id, amount):
+    """
+    Record the invoice amount (not the tip) as a payment on the GHL invoice. Before a retry the
+    GHL invoice is checked, so a timed-out attempt that did go through is not recorded twice.
+    """
+    return _run_payment_step(
+        self, invoice_id, "ghl_payment",
+        lambda invoice: record_payment_in_ghl(invoice, float(amount)),
+        already_applied=ghl_invoice_payment_recorded,
+    )
+
+
+@shared_task(bind=True, max_retries=8)
+def add_invoice_paid_tag(self, invoice_id):
+    """Add the "invoice_paid" tag to the invoice's GHL contact (safe to repeat)"""
+    return _run_payment_step(
+        self, invoice_id, "ghl_paid_tag",
+        lambda invoice: add_invoice_paid_tag_to_contact(invoice.contact_id, invoice.location_id),
+        idempotent=True,
+    )
+
+
+@shared_task(bind=True, max_retries=8)
+def send_tip_webhook(self, invoice_id, tip_amount, tip_notes=None):
+    """Send the customer's tip to the Service Pilot tip webhook (only retried when it provably was not delivered)"""
+    return _run_payment_step(self, invoice_id, "tip_webhook", lambda invoice: trigger_tip_webhook(invoice.job_id, float(tip_amount), tip_notes))
+
+
+def queue_payment_steps(invoice, ghl_amount=None, tip_amount=None, tip_notes=None):
+    """
+    Queue the post-payment side effects for a paid invoice. Tasks are sent once the
+    current transaction commits; a step already queued for this invoice is not queued again.
+
+    Args:
+        invoice (Invoice): The paid invoice
+        ghl_amount: Invoice amount to record in GHL (and tag the contact); None when the
+            invoice was already paid before this payment was seen
+        tip_amount (float, optional): Tip to forward to Service Pilot (needs invoice.job_id)
+        tip_notes (str, optional): Tip notes
+
+    Returns:
+        list: Steps queued by this call
+    """
+    steps = []
+    if ghl_amount is not None:
+        if invoice.ghl_invoice_id:
+            steps.append(("ghl_payment", record_invoice_payment_in_ghl, (invoice.pk, str(ghl_amount))))
+        else:
+            print(f"Invoice {invoice.invoice_number} does not have GHL invoice ID, skipping GHL payment recording")
+        steps.append(("ghl_paid_tag", add_invoice_paid_tag, (invoice.pk,)))
+    if tip_amount and tip_amount > 0 and invoice.job_id:
+        steps.append(("tip_webhook", send_tip_webhook, (invoice.pk, str(tip_amount), tip_notes)))
+
+    queued = []
+    for step, task, args in steps:
+        _, created = InvoicePaymentStep.objects.get_or_create(invoice=invoice, step=step)
+        if created:
+            transaction.on_commit(lambda task=task, args=args: task.delay(*args))
+            queued.append(step)
+    return queued
@@ -1,3 +1,127 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
 
-# Create your tests here.
+from django.http import JsonResponse
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from .idempotency import claim, idempotent_webhook, payload_hash_key, stripe_event_key
+from .models import WebhookDelivery
+
+
+class IdempotentWebhookTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.calls = 0
+        self.response = lambda: JsonResponse({"message": "Webhook received", "call": self.calls})
+
+        @idempotent_webhook("test")
+        def view(request):
+            self.calls += 1
+            return self.response()
+
+        self.view = view
+
+    def post(self, body):
+        return self.view(self.factory.post("/", json.dumps(body), content_type="application/json"))
+
+    def key(self, body):
+        return payload_hash_key(self.factory.post("/", json.dumps(body), content_type="application/json"))
+
+    def test_first_delivery_runs_view_and_stores_response(self):
+        response = self.post({"a": 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls, 1)
+        delivery = WebhookDelivery.objects.get(endpoint="test")
+        self.assertEqual(delivery.status, "done")
+        self.assertEqual(delivery.response_status, 200)
+        self.assertEqual(delivery.response_body, {"message": "Webhook received", "call": 1})
+
+    def test_duplicate_after_completion_is_replayed(self):
+        self.response = lambda: JsonResponse({"created": True}, status=201)
+        self.post({"a": 1, "b": 2})
+
+        # Same payload with keys in a different order
+        response = self.post({"b": 2, "a": 1})
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content), {"created": True})
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+
+    def test_duplicate_while_processing_gets_409(self):
+        delivery, claimed = claim("test", self.key({"a": 1}))
+        self.assertTrue(claimed)
+
+        response = self.post({"a": 1})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.calls, 0)
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, "processing")
+
+    def test_server_error_releases_claim(self):
+        self.response = lambda: JsonResponse({"error": "boom"}, status=500)
+        self.assertEqual(self.post({"a": 1}).status_code, 500)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+        self.response = lambda: JsonResponse({"message": "ok"})
+        self.assertEqual(self.post({"a": 1}).status_code, 200)
+        self.assertEqual(self.calls, 2)
+
+    def test_exception_releases_claim(self):
+        @idempotent_webhook("test")
+        def failing(request):
+            raise RuntimeError("boom")
+
+        request = self.factory.post("/", json.dumps({"a": 1}), content_type="application/json")
+        with self.assertRaises(RuntimeError):
+            failing(request)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+        self.assertEqual(self.post({"a": 1}).status_code, 200)
+        self.assertEqual(self.calls, 1)
+
+    def test_expired_record_is_taken_over(self):
+        self.post({"a": 1})
+        WebhookDelivery.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        response = self.post({"a": 1})
+
+        self.assertEqual(self.calls, 2)
+        self.assertNotIn("Idempotent-Replayed", response)
+        delivery = WebhookDelivery.objects.get(endpoint="test")
+        self.assertEqual(delivery.status, "done")
+        self.assertEqual(delivery.response_body["call"], 2)
+        self.assertGreater(delivery.expires_at, timezone.now())
+
+    def test_abandoned_processing_record_is_taken_over(self):
+        claim("test", self.key({"a": 1}))
+        WebhookDelivery.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+        response = self.post({"a": 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls, 1)
+
+    def test_claim_takes_over_only_once(self):
+        claim("test", "k")
+        WebhookDelivery.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        _, first = claim("test", "k")
+        _, second = claim("test", "k")
+
+        self.assertTrue(first)
+        self.assertFalse(second)
+
+    def test_non_post_is_not_deduplicated(self):
+        self.view(self.factory.get("/"))
+        self.view(self.factory.get("/"))
+
+        self.assertEqual(self.calls, 2)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_stripe_event_key_uses_event_id(self):
+        request = self.factory.post("/", json.dumps({"id": "evt_1", "type": "x"}), content_type="application/json")
+        self.assertEqual(stripe_event_key(request), "evt_1")
@@ -3,6 +3,7 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from . import views
 urlpatterns = [
     path("webhook/", views.webhook_handler),
+    path("webhook/status/<uuid:token>/", views.InvoiceWebhookStatusView.as_view(), name='invoice-webhook-status'),
     path("webhook/user-create/", views.user_create_webhook_handler),
     path("webhook/payroll/", views.payroll_webhook_handler),
     path("webhook/invoice-paid/", views.invoice_paid_webhook_handler, name='invoice-paid-webhook'),
@@ -14,12 +15,15 @@ urlpatterns = [
     path('create/job/', views.CreateJob.as_view()),
     path('create/job/validations/', views.CreateJobValidations.as_view()),
     path('payroll/', views.PayrollView.as_view()),
+    path('payroll/export/', views.PayrollExportView.as_view(), name='payroll-export'),
     path("payroll/<str:user_id>/", views.PayrollView.as_view(), name="percentage-update"),
     path("payroll/commission/<str:user_id>/", views.CommissionRuleUpdateView.as_view()),
     path('commissions/<str:user_id>/<int:commission_id>/', views.CommissionRuleUpdateView.as_view()),
     path('invoice/<uuid:token>/', views.PublicInvoiceView.as_view(), name='public-invoice-view'),
     path('invoice/<uuid:token>/signature/', views.SaveInvoiceSignature.as_view(), name='save-invoice-signature'),
+    path('invoice/<uuid:token>/signature/image/', views.InvoiceSignatureImageView.as_view(), name='invoice-signature-image'),
     path('invoice/<uuid:token>/verify-payment/', views.VerifyPaymentStatus.as_view(), name='verify-payment-status'),
+    path('invoice/<uuid:token>/payment-status/', views.InvoicePaymentStatusView.as_view(), name='invoice-payment-status'),
     path('invoice/<uuid:token>/create-checkout-session/', views.CreateStripeCheckoutSession.as_view(), name='create-stripe-checkout'),
     path('stripe/webhook/', views.stripe_webhook_handler, name='stripe-webhook'),
 ]
@@ -1,15 +1,115 @@
 import requests
-from ghl_auth.models import GHLAuthCredentials
-
-from datetime import datetime
+from ghl_auth import client as ghl_client
+from ghl_auth.registry import get_credentials
+from .models import GHLProduct
+
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 from django.conf import settings
+from django.db import connection, connections
+from django.utils import timezone
 
 PIPELINE_ID = settings.PIPELINE_ID
 PIPELINE_STAGE_ID = settings.PIPELINE_STAGE_ID
 
+def normalize_product_name(product_name):
+    return " ".join(str(product_name).split()).casefold()
+
+
 def get_or_create_product(access_token, location_id, product_name, custom_data):
+    """
+    Resolve a GHL product for the given name, answering from the local GHLProduct cache when fresh.
+
+    An advisory lock on the product name is held while GHL is searched, so two concurrent
+    webhooks for the same product wait on each other instead of both creating it. No
+    transaction stays open during the GHL calls.
+    """
+    normalized_name = normalize_product_name(product_name)
+    entry, _ = GHLProduct.objects.get_or_create(
+        location_id=location_id,
+        normalized_name=normalized_name,
+        defaults={"name": product_name},
+    )
+    if product_entry_is_fresh(entry):
+        return {"productId": entry.product_id, "priceId": entry.price_id}
+
+    with product_lock(location_id, normalized_name):
+        # Another worker may have resolved it while we waited for the lock
+        entry.refresh_from_db()
+        if product_entry_is_fresh(entry):
+            return {"productId": entry.product_id, "priceId": entry.price_id}
+
+        if location_catalog_is_fresh(location_id):
+            # The full catalog was synced recently, so a name missing from it is a new product
+            product_info = create_product(access_token, location_id, product_name, custom_data)
+        else:
+            product_info = search_or_create_product(access_token, location_id, product_name, custom_data)
+        if product_info:
+            entry.name = product_name
+            entry.product_id = product_info.get("productId")
+            entry.price_id = product_info.get("priceId")
+            entry.resolved_at = timezone.now()
+            entry.save(update_fields=["name", "product_id", "price_id", "resolved_at"])
+        return product_info
+
+
+def product_entry_is_fresh(entry):
+    fresh_after = timezone.now() - timedelta(seconds=settings.PRODUCT_CACHE_TTL)
+    return bool(entry.product_id and entry.resolved_at and entry.resolved_at > fresh_after)
+
+
+@contextmanager
+def product_lock(location_id, normalized_name):
+    """Session-level PostgreSQL advisory lock for one product name (a no-op on other databases)"""
+    if connection.vendor != "postgresql":
+        yield
+        return
+    digest = hashlib.sha256(f"ghl_product:{location_id}:{normalized_name}".encode()).digest()
+    key = int.from_bytes(digest[:8], "big", signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", [key])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+def location_catalog_is_fresh(location_id):
+    synced_after = timezone.now() - timedelta(seconds=settings.PRODUCT_CATALOG_MAX_AGE)
+    credentials = get_credentials(location_id, fallback=False)
+    return bool(credentials and credentials.products_synced_at and credentials.products_synced_at >= synced_after)
+
+
+def fetch_products_page(access_token, location_id, offset, limit):
+    """Fetch one page of a location's GHL product list."""
+    headers = {
+        'Accept': 'application/json',
+        'Authorization': f'Bearer {access_token}',
+        'Version': '2021-07-28'
+    }
+    response = ghl_client.get(
+        "https://services.leadconnectorhq.com/products/",
+        headers=headers,
+        params={"locationId": location_id, "limit": limit, "offset": offset},
+    )
+    response.raise_for_status()
+    return response.json().get("products", [])
+
+
+def invalidate_cached_products(location_id, product_ids):
+    """Forget cached product ids (e.g. after GHL answered 404 for them). Returns the number of entries dropped."""
+    return GHLProduct.objects.filter(location_id=location_id, product_id__in=product_ids).update(
+        product_id=None, price_id=None, resolved_at=None
+    )
+
+
+def search_or_create_product(access_token, location_id, product_name, custom_data):
     headers = {
         'Accept': 'application/json',
         'Authorization': f'Bearer {access_token}',
@@ -19,7 +119,7 @@ def get_or_create_product(access_token, location_id, product_name, custom_data):
     search_url = f"https://services.leadconnectorhq.com/products/?locationId={location_id}&search={product_name}"
     
     try:
-        response = requests.get(search_url, headers=headers)
+        response = ghl_client.get(search_url, headers=headers)
         if response.status_code == 200:
             products = response.json().get('products', [])
             if products:
@@ -62,7 +162,7 @@ def create_product(access_token, location_id, product_name, custom_data):
     url = "https://services.leadconnectorhq.com/products/"
 
     try:
-        response = requests.post(url, headers=headers, json=product_data)
+        response = ghl_client.post(url, headers=headers, json=product_data)
         print(response.json(), 'response')
         if response.status_code in [200, 201]:
             product = response.json()
@@ -94,7 +194,7 @@ def create_opportunity(contact_id, name, monetary_value, is_first_time):
 
     url = 'https://services.leadconnectorhq.com/opportunities/'
 
-    credentials = GHLAuthCredentials.objects.first()
+    credentials = get_credentials()
 
     headers = {
         "Authorization": f"Bearer {credentials.access_token}",
@@ -129,7 +229,7 @@ def create_opportunity(contact_id, name, monetary_value, is_first_time):
     #         "custom_field_services_abc123": services
     #     }
 
-    response = requests.post(
+    response = ghl_client.post(
         url,
         json=payload,
         headers=headers
@@ -137,49 +237,69 @@ def create_opportunity(contact_id, name, monetary_value, is_first_time):
 
     return response.json()
 
-def create_invoice(name, contact_id, services, credentials, customer_address=None, companyName=None, phoneNo=None, contactName=None, contact_email=None, discount=None):
-    """
-    Create an invoice in GHL for the given contact.
+_product_executor = None
+_product_executor_lock = threading.Lock()
 
-    Args:
-        contact_id (str): GHL contact ID
-        location_id (str): GHL location ID
-        services (list): List of services (product objects)
-        credentials: GHLAuthCredentials instance
-        customer_address (str, optional): Customer address
-        companyName (str, optional): Company name
-        phoneNo (str, optional): Phone number
-        contactName (str, optional): Contact name
-        contact_email (str, optional): Contact email (preferred from GHL contact or webhook payload)
-        discount (dict, optional): Optional. When omitted or None, no discount is applied (value=0, type=fixed).
-            When provided: { "value": number, "type": "percentage"|"fixed", "validOnProductIds": optional }
+
+def get_product_executor():
+    """
+    Process-wide pool for product lookups. Its threads live as long as the process, so
+    each keeps its pooled GHL session (ghl_auth.client) and its database connection
+    across invoices. Created on first use so forked workers each start their own.
+    """
+    global _product_executor
+    if _product_executor is None:
+        with _product_executor_lock:
+            if _product_executor is None:
+                _product_executor = ThreadPoolExecutor(
+                    max_workers=settings.INVOICE_PRODUCT_WORKERS,
+                    thread_name_prefix="ghl-product",
+                )
+    return _product_executor
+
+
+def _resolve_product(access_token, location_id, product_name, custom_data):
+    # Runs on a long-lived pool thread: keep its DB connection, but drop one that broke
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is not None and not conn.is_usable():
+            conn.close()
+    return get_or_create_product(access_token, location_id, product_name, custom_data=custom_data)
+
+
+def resolve_products(services, credentials):
+    """
+    Resolve GHL products for all services concurrently on the shared product pool.
+    Services whose names normalize to the same value share a single lookup.
 
     Returns:
-        dict: Response from GHL API
+        dict: normalized product name -> product info (None when resolution failed)
     """
-    url = "https://services.leadconnectorhq.com/invoices/"
-    headers = {
-        "Authorization": f"Bearer {credentials.access_token}",
-        "Content-Type": "application/json",
-        "Version": "2021-07-28"
+    unique_services = {}
+    for service in services:
+        product_name = service.get("name", "Unnamed Service")
+        unique_services.setdefault(normalize_product_name(product_name), (product_name, service))
+
+    if not unique_services:
+        return {}
+
+    executor = get_product_executor()
+    futures = {
+        key: executor.submit(_resolve_product, credentials.access_token, credentials.location_id, product_name, service)
+        for key, (product_name, service) in unique_services.items()
     }
+    return {key: future.result() for key, future in futures.items()}
 
-    # Validate email is provided and valid
-    if not contact_email or not isinstance(contact_email, str) or "@" not in contact_email:
-        return {"error": "Valid contact email is required. Email must be provided from GHL contact or webhook payload."}
-    
+
+def build_invoice_line_items(services, credentials):
+    """Resolve a GHL product for every service and build the invoice line items."""
+    products = resolve_products(services, credentials)
     line_items = []
 
     for service in services:
         product_name = service.get("name", "Unnamed Service")
         print("Processing service:", product_name)  # DEBUG
 
-        product_info = get_or_create_product(
-            credentials.access_token,
-            credentials.location_id,
-            product_name,
-            custom_data=service
-        )
+        product_info = products.get(normalize_product_name(product_name))
         if not product_info:
             print(f"Skipping service: {product_name} (no product info)")
             continue  # <-- change return to continue, so other services are still added
@@ -206,6 +326,42 @@ def create_invoice(name, contact_id, services, credentials, customer_address=Non
 
         line_items.append(line_item)
 
+    return line_items
+
+
+def create_invoice(name, contact_id, services, credentials, customer_address=None, companyName=None, phoneNo=None, contactName=None, contact_email=None, discount=None):
+    """
+    Create an invoice in GHL for the given contact.
+
+    Args:
+        contact_id (str): GHL contact ID
+        location_id (str): GHL location ID
+        services (list): List of services (product objects)
+        credentials: GHLAuthCredentials instance
+        customer_address (str, optional): Customer address
+        companyName (str, optional): Company name
+        phoneNo (str, optional): Phone number
+        contactName (str, optional): Contact name
+        contact_email (str, optional): Contact email (preferred from GHL contact or webhook payload)
+        discount (dict, optional): Optional. When omitted or None, no discount is applied (value=0, type=fixed).
+            When provided: { "value": number, "type": "percentage"|"fixed", "validOnProductIds": optional }
+
+    Returns:
+        dict: Response from GHL API
+    """
+    url = "https://services.leadconnectorhq.com/invoices/"
+    headers = {
+        "Authorization": f"Bearer {credentials.access_token}",
+        "Content-Type": "application/json",
+        "Version": "2021-07-28"
+    }
+
+    # Validate email is provided and valid
+    if not contact_email or not isinstance(contact_email, str) or "@" not in contact_email:
+        return {"error": "Valid contact email is required. Email must be provided from GHL contact or webhook payload."}
+    
+    line_items = build_invoice_line_items(services, credentials)
+
     print("Final line_items payload:", line_items)  # DEBUG
 
     # Build discount for GHL API (optional: from webhook payload when provided; otherwise no discount)
@@ -263,7 +419,13 @@ def create_invoice(name, contact_id, services, credentials, customer_address=Non
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = ghl_client.post(url, headers=headers, json=payload)
+    if response.status_code == 404:
+        # A cached product may have been deleted in GHL: drop the cached ids and resolve them again once
+        product_ids = [item["productId"] for item in line_items]
+        if invalidate_cached_products(credentials.location_id, product_ids):
+            payload["items"] = build_invoice_line_items(services, credentials)
+            response = ghl_client.post(url, headers=headers, json=payload)
     return response.json()
 
 
@@ -289,14 +451,14 @@ def add_followers(id, followers, credentials):
     }
 
     try:
-        response = requests.post(url=url, headers=headers, json=payload)
+        response = ghl_client.post(url=url, headers=headers, json=payload)
         return response.json()
     except Exception as e:
         return {"error": str(e)}
     
 def send_invoice(invoiceId):
     url = f'https://services.leadconnectorhq.com/invoices/{invoiceId}/send'
-    credentials = GHLAuthCredentials.objects.first()
+    credentials = get_credentials()
     
     headers = {
         'Authorization': f'Bearer {credentials.access_token}',
@@ -312,7 +474,7 @@ def send_invoice(invoiceId):
     }
 
     try:
-        response = requests.post(url=url, headers=headers, json=payload)
+        response = ghl_client.post(url=url, headers=headers, json=payload)
         print('invoice_response', response.json())
         return response.json()
     except Exception as e:
@@ -329,7 +491,7 @@ def fetch_opportunity_by_id(opportunity_id):
     """
     Fetch a single opportunity's details from GHL by ID.
     """
-    credentials = GHLAuthCredentials.objects.first()
+    credentials = get_credentials()
 
     url = f"https://services.leadconnectorhq.com/opportunities/{opportunity_id}"
 
@@ -340,7 +502,7 @@ def fetch_opportunity_by_id(opportunity_id):
     }
 
     try:
-        response = requests.get(url=url, headers=headers)
+        response = ghl_client.get(url=url, headers=headers)
         print(response.json(), 'response fetch opp')
         if response.status_code == 200:
             return response.json().get("opportunity", {})
@@ -354,7 +516,7 @@ def fetch_opportunity_by_id(opportunity_id):
 
 def search_ghl_contact(access_token, email, locationId):
     url = 'https://services.leadconnectorhq.com/contacts/'
-    response = requests.get(
+    response = ghl_client.get(
         url,
         headers={
             'Accept': 'application/json',
@@ -368,7 +530,7 @@ def search_ghl_contact(access_token, email, locationId):
 
 def update_contact(contact_id, data):
     url = f'https://services.leadconnectorhq.com/contacts/{contact_id}'
-    credentials = GHLAuthCredentials.objects.first()
+    credentials = get_credentials()
     print(credentials, 'creee')
 
     headers = {
@@ -378,7 +540,7 @@ def update_contact(contact_id, data):
     }
 
     try:
-        response = requests.put(url, headers=headers, json=data)
+        response = ghl_client.put(url, headers=headers, json=data)
         print(response.json(), 'responseeeeee')
         return response.json()
     except Exception as e:
@@ -387,7 +549,7 @@ def update_contact(contact_id, data):
 
 def getBussiness(access_token, businessId):
     url = 'https://services.leadconnectorhq.com/businesses/'
-    response = requests.get(
+    response = ghl_client.get(
         url,
         headers={
             'Accept': 'application/json',
@@ -413,11 +575,7 @@ def add_invoice_paid_tag_to_contact(contact_id, location_id=None):
     """
     try:
         # Get GHL credentials - try to get by location_id first, otherwise get first
-        credentials = None
-        if location_id:
-            credentials = GHLAuthCredentials.objects.filter(location_id=location_id).first()
-        if not credentials:
-            credentials = GHLAuthCredentials.objects.first()
+        credentials = get_credentials(location_id)
         
         if not credentials:
             print("No GHL credentials found for adding invoice_paid tag")
@@ -432,7 +590,7 @@ def add_invoice_paid_tag_to_contact(contact_id, location_id=None):
         }
         
         try:
-            get_response = requests.get(url, headers=headers)
+            get_response = ghl_client.get(url, headers=headers)
             if get_response.status_code != 200:
                 print(f"Failed to fetch contact {contact_id}: {get_response.status_code}")
                 return {"success": False, "error": f"Failed to fetch contact: {get_response.status_code}"}
@@ -485,7 +643,9 @@ def record_payment_in_ghl(invoice, amount_paid):
         amount_paid: Decimal amount that was paid
     
     Returns:
-        dict with success status and response data or error message
+        dict with success status and response data or error message. Failed results set
+        "retryable" when GHL provably did not apply the payment (never sent, or 429) and
+        "uncertain" when it may have (read timeout, 5xx).
     """
     # Check if invoice has GHL invoice ID
     if not invoice.ghl_invoice_id:
@@ -494,18 +654,14 @@ def record_payment_in_ghl(invoice, amount_paid):
     
     # Get GHL credentials - try to get by location_id first, otherwise get first
     try:
-        credentials = None
-        if invoice.location_id:
-            credentials = GHLAuthCredentials.objects.filter(location_id=invoice.location_id).first()
-        if not credentials:
-            credentials = GHLAuthCredentials.objects.first()
+        credentials = get_credentials(invoice.location_id)
         
         if not credentials:
             print("No GHL credentials found")
-            return {"success": False, "error": "No GHL credentials found"}
+            return {"success": False, "error": "No GHL credentials found", "retryable": True}
     except Exception as e:
         print(f"Error getting GHL credentials: {e}")
-        return {"success": False, "error": f"Error getting credentials: {str(e)}"}
+        return {"success": False, "error": f"Error getting credentials: {str(e)}", "retryable": True}
     
     # Prepare the API request
     url = f'https://services.leadconnectorhq.com/invoices/{invoice.ghl_invoice_id}/record-payment'
@@ -537,7 +693,7 @@ def record_payment_in_ghl(invoice, amount_paid):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payment_data, timeout=30)
+        response = ghl_client.post(url, headers=headers, json=payment_data)
         
         if response.status_code in [200, 201]:
             print(f"Successfully recorded payment in GHL for invoice {invoice.invoice_number}")
@@ -551,14 +707,19 @@ def record_payment_in_ghl(invoice, amount_paid):
             return {
                 "success": False,
                 "error": error_msg,
-                "status_code": response.status_code
+                "status_code": response.status_code,
+                "retryable": response.status_code == 429,
+                "uncertain": response.status_code >= 500,
             }
     except requests.exceptions.RequestException as e:
         error_msg = f"Request error recording payment in GHL: {str(e)}"
         print(error_msg)
+        sent = not ghl_client.never_sent(e)
         return {
             "success": False,
-            "error": error_msg
+            "error": error_msg,
+            "retryable": not sent,
+            "uncertain": sent,
         }
     except Exception as e:
         error_msg = f"Unexpected error recording payment in GHL: {str(e)}"
@@ -571,10 +732,49 @@ def record_payment_in_ghl(invoice, amount_paid):
         }
 
 
+def ghl_invoice_payment_recorded(invoice):
+    """
+    Whether the GHL invoice is already fully paid, so an earlier record-payment that failed
+    ambiguously (timeout, 5xx) is not posted again.
+
+    Returns:
+        bool, or None when GHL could not be asked
+    """
+    credentials = get_credentials(invoice.location_id)
+    if not credentials:
+        return None
+    headers = {
+        'Accept': 'application/json',
+        'Version': '2021-07-28',
+        'Authorization': f'Bearer {credentials.access_token}'
+    }
+    try:
+        response = ghl_client.get(
+            f'https://services.leadconnectorhq.com/invoices/{invoice.ghl_invoice_id}',
+            headers=headers,
+            params={"altId": invoice.location_id, "altType": "location"},
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching GHL invoice {invoice.ghl_invoice_id}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error fetching GHL invoice {invoice.ghl_invoice_id}: {response.status_code}")
+        return None
+    data = response.json()
+    data = data.get("invoice", data)
+    try:
+        return float(data.get("amountDue")) <= 0.005
+    except (TypeError, ValueError):
+        return None
+
+
 def trigger_tip_webhook(job_id, tip_amount, notes=None):
     """
     Call Service Pilot tip webhook after a customer adds a tip and completes payment.
     POST https://services.theservicepilot.com/api/job/tip-webhook/
+
+    Failed results set "retryable" only when the tip provably was not delivered (the
+    connection was never made, or 429); a timeout or 5xx may already have recorded it.
     """
     if not job_id or tip_amount is None or float(tip_amount) <= 0:
         return {"success": False, "error": "job_id and positive tip_amount required"}
@@ -598,11 +798,12 @@ def trigger_tip_webhook(job_id, tip_amount, notes=None):
             "success": False,
             "error": f"Tip webhook returned {response.status_code}: {response.text}",
             "status_code": response.status_code,
+            "retryable": response.status_code == 429,
         }
     except requests.exceptions.RequestException as e:
         error_msg = f"Request error calling tip webhook: {e}"
         print(error_msg)
-        return {"success": False, "error": error_msg}
+        return {"success": False, "error": error_msg, "retryable": ghl_client.never_sent(e)}
     except Exception as e:
         error_msg = f"Unexpected error calling tip webhook: {e}"
         print(error_msg)
@@ -5,24 +5,41 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework.generics import ListAPIView
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
-from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.db.models import Sum, Max, Count, Prefetch, Func, CharField
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 import stripe
 import os
-
-from .models import Service, Contact, Job, WebhookLog, Invoice, InvoiceItem
-from ghl_auth.models import GHLAuthCredentials, GHLUser, CommissionRule
-from .seriallizers import ServiceSerializer, ContactSerializer, GHLUserSerializer, PayrollSerializer, GHLUserPercentageEditSerializer, CommissionRuleEditSerializer
-from .utils import create_opportunity, create_invoice, add_followers, record_payment_in_ghl, add_invoice_paid_tag_to_contact, trigger_tip_webhook
-from .tasks import handle_webhook_event, handle_user_create_webhook_event, payroll_webhook_event
-
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from .models import Service, ContactSearchEntry, normalize_search_term, Job, Invoice, InvoiceItem, InvoiceSignature, InvoicePaymentStep, InvoiceWebhookRequest, Payout
+from ghl_auth.models import GHLUser, CommissionRule
+from ghl_auth.registry import get_credentials
+from ghl_auth.utils import search_users, user_search_cache_key, invalidate_user_search_cache
+from .seriallizers import ServiceSerializer, ContactSearchEntrySerializer, GHLUserSerializer, PayrollSerializer, GHLUserPercentageEditSerializer, CommissionRuleEditSerializer, payout_date_filter, payout_rollup_filter, validate_commission_rules, get_public_invoice, signature_reference
+from .utils import create_opportunity, create_invoice, add_followers, add_invoice_paid_tag_to_contact
+from .webhook_log import log_webhook
+from .stripe_client import get_stripe_client
+from .idempotency import idempotent_webhook, stripe_event_key
+from . import payment_state
+from .tasks import handle_webhook_event, handle_user_create_webhook_event, payroll_webhook_event, process_invoice_webhook_request
+
+import csv
+import hashlib
+import itertools
 import json
 # Create your views here.
 
 
 @csrf_exempt
+@idempotent_webhook("ghl_invoice")
 def webhook_handler(request):
     if request.method != "POST":
         return JsonResponse({"message": "Method not allowed"}, status=405)
@@ -30,7 +47,11 @@ def webhook_handler(request):
     try:
         data = json.loads(request.body)
         print("date:----- ", data)
-        WebhookLog.objects.create(data=data)
+        log_webhook("ghl_invoice", data)
+
+        if settings.INVOICE_WEBHOOK_ASYNC:
+            return accept_invoice_webhook(request, data)
+
         # Call function directly (non-celery)
         result = handle_webhook_event(data)
         
@@ -52,6 +73,72 @@ def webhook_handler(request):
         return JsonResponse({"error": str(e)}, status=500)
 
 
+def accept_invoice_webhook(request, data):
+    """
+    Async webhook mode: persist the payload under a pre-minted invoice token,
+    queue the GHL work on Celery and answer 202 straight away.
+    """
+    webhook_request = InvoiceWebhookRequest.objects.create(payload=data)
+    try:
+        process_invoice_webhook_request.delay(str(webhook_request.token))
+    except Exception as e:
+        webhook_request.status = "failed"
+        webhook_request.error = f"Failed to queue webhook: {e}"
+        webhook_request.save(update_fields=["status", "error", "updated_at"])
+        raise
+
+    response_data = {
+        "message": "Webhook accepted",
+        "invoice_token": str(webhook_request.token),
+        "status": webhook_request.status,
+        "status_url": request.build_absolute_uri(
+            reverse("invoice-webhook-status", kwargs={"token": webhook_request.token})
+        ),
+    }
+
+    # Only invoices for this location are saved locally and get a public page
+    if data.get("location_id") == "b8qvo7VooP3JD3dIZU42":
+        frontend_url = settings.FRONTEND_URL or "http://localhost:5173"
+        frontend_url = frontend_url.rstrip('/')
+        response_data["invoice_url"] = f"{frontend_url}/invoice/{webhook_request.token}/"
+
+    return JsonResponse(response_data, status=202)
+
+
+class InvoiceWebhookStatusView(APIView):
+    """
+    Public status of an invoice webhook accepted in async mode
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request, token):
+        try:
+            webhook_request = InvoiceWebhookRequest.objects.get(token=token)
+        except InvoiceWebhookRequest.DoesNotExist:
+            return Response({"error": "Webhook request not found"}, status=404)
+
+        invoice = webhook_request.invoice
+        response_data = {
+            "invoice_token": str(webhook_request.token),
+            "status": webhook_request.status,
+            "ghl_invoice_id": webhook_request.ghl_invoice_id,
+            "invoice_created": webhook_request.status in ("created", "sent"),
+            "invoice_sent": webhook_request.status == "sent",
+            "error": webhook_request.error,
+            "created_at": webhook_request.created_at.isoformat(),
+            "updated_at": webhook_request.updated_at.isoformat(),
+        }
+        if invoice:
+            frontend_url = settings.FRONTEND_URL or "http://localhost:5173"
+            frontend_url = frontend_url.rstrip('/')
+            response_data["invoice_url"] = f"{frontend_url}/invoice/{invoice.token}/"
+            response_data["invoice_number"] = invoice.invoice_number
+            response_data["sent_at"] = invoice.sent_at.isoformat() if invoice.sent_at else None
+
+        return Response(response_data)
+
+
 @csrf_exempt
 def user_create_webhook_handler(request):
     if request.method != "POST":
@@ -60,7 +147,7 @@ def user_create_webhook_handler(request):
     try:
         data = json.loads(request.body)
         print("date:----- ", data)
-        WebhookLog.objects.create(data=data)
+        log_webhook("ghl_user", data)
         event_type = data.get("type")
         handle_user_create_webhook_event.delay(data, event_type)
         return JsonResponse({"message":"Webhook received"}, status=200)
@@ -75,7 +162,7 @@ def payroll_webhook_handler(request):
     try:
         data = json.loads(request.body)
         print("date:----- ", data)
-        WebhookLog.objects.create(data=data)
+        log_webhook("ghl_payroll", data)
         payroll_webhook_event.delay(data)
         return JsonResponse({"message":"Webhook received"}, status=200)
     except Exception as e:
@@ -83,6 +170,32 @@ def payroll_webhook_handler(request):
     
 
     
+SERVICE_CATALOG_VERSION_KEY = "service_catalog:version"
+
+
+def service_catalog_version():
+    """
+    (max(updated_at), row count) of the external service table. Any edit, insert or delete
+    changes it. Kept in the cache for SERVICE_CATALOG_VERSION_TTL seconds so repeated
+    catalog loads do not query the external database.
+    """
+    version = cache.get(SERVICE_CATALOG_VERSION_KEY)
+    if version is None:
+        stats = Service.objects.using('external').aggregate(last_modified=Max('updated_at'), count=Count('id'))
+        version = (stats['last_modified'], stats['count'])
+        cache.set(SERVICE_CATALOG_VERSION_KEY, version, settings.SERVICE_CATALOG_VERSION_TTL)
+    return version
+
+
+def set_validators(response, etag, last_modified=None):
+    """Attach ETag / Last-Modified and require revalidation (responses are per-user, never shared)"""
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
 class ServicesView(ListAPIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -94,20 +207,42 @@ class ServicesView(ListAPIView):
         if name:
             queryset = queryset.filter(name__icontains=name)
         return queryset
+
+    def list(self, request, *args, **kwargs):
+        last_modified, count = service_catalog_version()
+        name = request.query_params.get('name') or ''
+        page = request.query_params.get('page') or '1'
+        version = hashlib.sha1(
+            f"{last_modified.isoformat() if last_modified else ''}:{count}:{name}:{page}".encode()
+        ).hexdigest()
+        etag = quote_etag(version)
+
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None
+        )
+        if not_modified is not None:
+            return set_validators(not_modified, etag, last_modified)
+
+        cache_key = f"service_catalog:{version}"
+        data = cache.get(cache_key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(cache_key, data, settings.SERVICE_CATALOG_CACHE_TTL)
+        return set_validators(Response(data), etag, last_modified)
         
 class ContactsView(ListAPIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
-    serializer_class = ContactSerializer
+    serializer_class = ContactSearchEntrySerializer
 
     def get_queryset(self):
-        search = self.request.query_params.get('search', '')
-        return Contact.objects.using('external').filter(
-            Q(first_name__icontains=search) |
-            Q(last_name__icontains=search) |
-            Q(email__icontains=search) |
-            Q(phone__icontains=search)
-        )
+        # Searches the local, trigram-indexed mirror of the external contacts table
+        # (kept current by api.tasks.sync_contact_search) instead of scanning the external DB
+        search = normalize_search_term(self.request.query_params.get('search', ''))
+        queryset = ContactSearchEntry.objects.order_by('id')
+        if search:
+            queryset = queryset.filter(search_text__contains=search)
+        return queryset
     
 class CreateJob(APIView):
     def post(self, request):
@@ -115,36 +250,15 @@ class CreateJob(APIView):
         assigned_to = request.data.get('assigned_to')
         name = request.data.get('title')
         is_first_time = request.data.get('is_first_time')
-        credentials = GHLAuthCredentials.objects.first()
+        credentials = get_credentials()
         if not credentials:
             return Response({"error": "No GHL credentials configured."}, status=500)
         
         assigned_to_ids = assigned_to if isinstance(assigned_to, list) else [assigned_to]
-        num_other_employees = len(assigned_to_ids)-1
-
-        for user_id in assigned_to_ids:
-            try:
-                user = GHLUser.objects.get(user_id=user_id)
-            except GHLUser.DoesNotExist:
-                return Response({"error": f"User with ID {user_id} not found."}, status=400)
-            
-            # Check commission rule
-            rule = CommissionRule.objects.filter(ghl_user=user, num_other_employees=num_other_employees).first()
 
-            if rule:
-                continue  # Valid rule exists
-            
-            # If no rule but 0 user, check flat_percentage
-            if num_other_employees == 0 and user.percentage is not None:
-                if user.percentage is not None:
-                    continue  # Valid flat_percentage
-                else:
-                    return Response({
-                        "error": f"Please set the flat commission percentage for {user.first_name} {user.last_name} when working alone."
-                    }, status=400)
-            return Response({
-                "error": f"No commission rule for user {user.first_name} {user.last_name} when working with {num_other_employees} other(s)."
-            }, status=400)
+        errors = [result["error"] for result in validate_commission_rules(assigned_to_ids) if not result["valid"]]
+        if errors:
+            return Response({"error": " ".join(errors), "errors": errors}, status=400)
 
         # You need to fetch service info from DB or pass it in request
         services = request.data.get("service")  # Expects a list of dicts
@@ -199,17 +313,18 @@ class GHLUserSearchView(ListAPIView):
     serializer_class = GHLUserSerializer
     permission_classes = [AllowAny]
 
-
     def get_queryset(self):
-        search = self.request.query_params.get('search', '')
-        return GHLUser.objects.filter(
-            Q(user_id__icontains=search) |
-            Q(first_name__icontains=search) |
-            Q(last_name__icontains=search) |
-            Q(name__icontains=search) |
-            Q(email__icontains=search) |
-            Q(phone__icontains=search)
-        )
+        return search_users(self.request.query_params.get('search', ''))
+
+    def list(self, request, *args, **kwargs):
+        # Pages are cached per (search, page) for a few seconds; user webhooks and
+        # pull_users bump the cache version so new or renamed users show up at once
+        cache_key = user_search_cache_key(request.query_params.get('search', ''), request.query_params.get('page'))
+        data = cache.get(cache_key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(cache_key, data, settings.GHL_USER_SEARCH_CACHE_TTL)
+        return Response(data)
     
 class PayrollView(APIView):
     permission_classes = [IsAdminUser]
@@ -218,7 +333,24 @@ class PayrollView(APIView):
         end_date = request.query_params.get("end_date")
         user_id = request.query_params.get("user_id")
 
-        users_qs = GHLUser.objects.prefetch_related("payouts").order_by("first_name")
+        # Totals are summed in SQL (from the per-day rollups when the range is whole days) and
+        # payouts prefetched with the same date filter, so the query count does not grow with headcount.
+        rollup_filter = payout_rollup_filter(start_date, end_date, prefix="payout_rollups__")
+        if rollup_filter is not None:
+            payout_total = Sum("payout_rollups__total", filter=rollup_filter)
+        else:
+            payout_total = Sum("payouts__amount", filter=payout_date_filter(start_date, end_date, prefix="payouts__"))
+
+        users_qs = GHLUser.objects.annotate(
+            payout_total=payout_total
+        ).prefetch_related(
+            Prefetch(
+                "payouts",
+                queryset=Payout.objects.filter(payout_date_filter(start_date, end_date)),
+                to_attr="filtered_payouts",
+            ),
+            "commission_rules",
+        ).order_by("first_name")
 
         # If user_id is passed, filter to just that user
         if user_id:
@@ -248,12 +380,74 @@ class PayrollView(APIView):
         serializer = GHLUserPercentageEditSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
+            invalidate_user_search_cache()
             return Response({
                 "message": "Percentage updated",
                 "percentage": serializer.data
             })
         return Response(serializer.errors, status=400)
     
+class ChicagoTimestamp(Func):
+    """Format a timestamp as America/Chicago local time inside PostgreSQL"""
+    template = "to_char(%(expressions)s AT TIME ZONE 'America/Chicago', 'YYYY-MM-DD HH12:MI:SS AM')"
+    output_field = CharField()
+
+
+class Echo:
+    """File-like object whose write() just returns the value, for streaming csv.writer output"""
+    def write(self, value):
+        return value
+
+
+class PayrollExportView(APIView):
+    """
+    Stream payouts as CSV (default) or NDJSON, filtered by start_date, end_date and user_id.
+    Rows are read through a server-side cursor so memory stays flat for any date range.
+    """
+    permission_classes = [IsAdminUser]
+
+    EXPORT_COLUMNS = ["user_id", "user_name", "opportunity_id", "opportunity_name", "amount", "created_at"]
+    CHUNK_SIZE = 2000
+
+    def get(self, request):
+        start_date = request.query_params.get("start_date")
+        end_date = request.query_params.get("end_date")
+        user_id = request.query_params.get("user_id")
+        # Not "format": DRF reserves that query parameter for renderer selection
+        export_format = request.query_params.get("export_format", "csv").lower()
+        if export_format not in ("csv", "ndjson"):
+            return Response({"error": "export_format must be 'csv' or 'ndjson'"}, status=400)
+
+        payouts = Payout.objects.filter(payout_date_filter(start_date, end_date))
+        if user_id:
+            payouts = payouts.filter(user__user_id=user_id)
+
+        rows = payouts.annotate(
+            created_at_local=ChicagoTimestamp("created_at"),
+        ).order_by("created_at", "id").values_list(
+            "user__user_id", "user__name", "opportunity_id", "opportunity_name", "amount", "created_at_local",
+        ).iterator(chunk_size=self.CHUNK_SIZE)
+
+        if export_format == "ndjson":
+            content = (
+                json.dumps(dict(zip(self.EXPORT_COLUMNS, row)), default=str) + "\n"
+                for row in rows
+            )
+            response = StreamingHttpResponse(content, content_type="application/x-ndjson")
+            filename = "payroll.ndjson"
+        else:
+            writer = csv.writer(Echo())
+            content = itertools.chain(
+                [writer.writerow(self.EXPORT_COLUMNS)],
+                (writer.writerow(row) for row in rows),
+            )
+            response = StreamingHttpResponse(content, content_type="text/csv")
+            filename = "payroll.csv"
+
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+
 class CommissionRuleUpdateView(APIView):
     permission_classes = [IsAdminUser]
 
@@ -313,39 +507,13 @@ class CreateJobValidations(APIView):
     def post(self, request):
         assigned_to = request.data.get('assigned_to')
         assigned_to_ids = assigned_to if isinstance(assigned_to, list) else [assigned_to]
-        num_other_employees = len(assigned_to_ids)-1
-
-        messages = []
-        success = True
 
         if not assigned_to:
             return Response({"error": "Assigned users cannot be empty."}, status=400)
 
-        for user_id in assigned_to_ids:
-            try:
-                user = GHLUser.objects.get(user_id=user_id)
-            except GHLUser.DoesNotExist:
-                messages.append(f"User with ID {user_id} not found.")
-                success = False
-                continue
-
-            rule = CommissionRule.objects.filter(
-                ghl_user=user, num_other_employees=num_other_employees
-            ).first()
-
-            if rule:
-                messages.append(
-                    f"{rule.commission_percentage}% for {user.first_name} (working with {num_other_employees} other(s))."
-                )
-            elif num_other_employees == 0 and user.percentage is not None:
-                messages.append(
-                    f"{user.percentage}% for {user.first_name} (working alone)."
-                )
-            else:
-                messages.append(
-                    f"No commission rule for {user.first_name} (working with {num_other_employees} other(s))."
-                )
-                success = False
+        results = validate_commission_rules(assigned_to_ids)
+        messages = [result["message"] for result in results]
+        success = all(result["valid"] for result in results)
 
         return Response({
             "success": success,
@@ -362,65 +530,23 @@ class PublicInvoiceView(APIView):
     
     def get(self, request, token):
         """
-        Retrieve invoice details by token
+        Retrieve invoice details by token (served from the cache while the invoice is unchanged)
         """
-        try:
-            invoice = Invoice.objects.prefetch_related('items').get(token=token)
-        except Invoice.DoesNotExist:
+        entry = get_public_invoice(token)
+        if entry is None:
             return Response(
                 {"error": "Invoice not found"},
                 status=404
             )
-        
-        # Serialize invoice data
-        invoice_data = {
-            "token": str(invoice.token),
-            "invoice_number": invoice.invoice_number,
-            "name": invoice.name,
-            "status": invoice.status,
-            "currency": invoice.currency,
-            "total": str(invoice.total),
-            "invoice_total": str(invoice.invoice_total) if invoice.invoice_total else None,
-            "amount_paid": str(invoice.amount_paid),
-            "amount_due": str(invoice.amount_due),
-            "discount_value": str(invoice.discount_value) if invoice.discount_value is not None else None,
-            "discount_type": invoice.discount_type,
-            "is_paid": invoice.is_paid,
-            "issue_date": invoice.issue_date.isoformat() if invoice.issue_date else None,
-            "due_date": invoice.due_date.isoformat() if invoice.due_date else None,
-            "contact": {
-                "name": invoice.contact_name,
-                "email": invoice.contact_email,
-                "phone": invoice.contact_phone,
-                "address": invoice.contact_address,
-                "company_name": invoice.contact_company_name,
-            },
-            "business": {
-                "name": invoice.business_name,
-                "logo_url": invoice.business_logo_url,
-            },
-            "location_id": invoice.location_id,
-            "items": [
-                {
-                    "name": item.name,
-                    "description": item.description,
-                    "quantity": str(item.quantity),
-                    "amount": str(item.amount),
-                    "currency": item.currency,
-                    "taxes": item.taxes,
-                    "tax_inclusive": item.tax_inclusive,
-                }
-                for item in invoice.items.all()
-            ],
-            "created_at": invoice.created_at.isoformat() if invoice.created_at else None,
-            "sent_at": invoice.sent_at.isoformat() if invoice.sent_at else None,
-            "signature": invoice.signature,
-            "signed_at": invoice.signed_at.isoformat() if invoice.signed_at else None,
-            "tip_amount": str(invoice.tip_amount) if invoice.tip_amount is not None and invoice.tip_amount > 0 else None,
-            "tip_notes": invoice.tip_notes or None,
-        }
 
-        return Response(invoice_data)
+        not_modified = get_conditional_response(request, etag=entry["etag"])
+        if not_modified is not None:
+            return set_validators(not_modified, entry["etag"])
+
+        data = entry["data"]
+        if data.get("signature"):
+            data = {**data, "signature": request.build_absolute_uri(data["signature"])}
+        return set_validators(Response(data), entry["etag"])
 
 
 class SaveInvoiceSignature(APIView):
@@ -435,7 +561,7 @@ class SaveInvoiceSignature(APIView):
         Save signature for invoice
         """
         try:
-            invoice = Invoice.objects.get(token=token)
+            invoice = Invoice.objects.only('id', 'token', 'signed_at').get(token=token)
         except Invoice.DoesNotExist:
             return Response(
                 {"error": "Invoice not found"},
@@ -448,18 +574,72 @@ class SaveInvoiceSignature(APIView):
                 {"error": "Signature is required"},
                 status=400
             )
-        
-        # Save signature and timestamp
-        invoice.signature = signature
-        invoice.signed_at = timezone.now()
-        invoice.save()
-        
+
+        try:
+            content_type, image = InvoiceSignature.decode_data_url(signature)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        if len(image) > settings.INVOICE_SIGNATURE_MAX_BYTES:
+            return Response({"error": "Signature image is too large"}, status=400)
+
+        # Save signature image (own table) and timestamp
+        with transaction.atomic():
+            try:
+                signature_image = InvoiceSignature.objects.get(invoice=invoice)
+            except InvoiceSignature.DoesNotExist:
+                signature_image = InvoiceSignature(invoice=invoice)
+            signature_image.set_image(content_type, image)
+            signature_image.save()
+
+            invoice.signed_at = timezone.now()
+            invoice.save(update_fields=["signed_at", "updated_at"])
+
         return Response({
             "message": "Signature saved successfully",
-            "signed_at": invoice.signed_at.isoformat()
+            "signed_at": invoice.signed_at.isoformat(),
+            "signature": request.build_absolute_uri(signature_reference(invoice, signature_image)),
         })
 
 
+class InvoiceSignatureImageView(APIView):
+    """
+    Serve an invoice's signature image. The public invoice links here with ?v=<digest>,
+    so a matching version can be cached by the browser indefinitely.
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request, token):
+        try:
+            signature = InvoiceSignature.objects.get(invoice__token=token)
+        except InvoiceSignature.DoesNotExist:
+            return Response({"error": "Signature not found"}, status=404)
+
+        # Only ever serve real PNG / JPEG bytes under their image type
+        if not signature.is_servable:
+            return Response({"error": "Signature not found"}, status=404)
+        etag = quote_etag(signature.digest)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            image = signature.image
+            if InvoiceSignature.detect_content_type(image) != signature.content_type:
+                return Response({"error": "Signature not found"}, status=404)
+            response = HttpResponse(image, content_type=signature.content_type)
+        response["ETag"] = etag
+        response["X-Content-Type-Options"] = "nosniff"
+        response["Content-Security-Policy"] = "sandbox"
+        if request.query_params.get("v") == signature.digest[:16]:
+            response["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response["Cache-Control"] = "no-cache"
+        return response
+
+
+def payment_steps_status(invoice):
+    """{step: status} of the invoice's queued post-payment side effects"""
+    return dict(InvoicePaymentStep.objects.filter(invoice=invoice).values_list("step", "status"))
+
+
 class VerifyPaymentStatus(APIView):
     """
     Verify and update payment status from Stripe checkout session
@@ -472,7 +652,7 @@ class VerifyPaymentStatus(APIView):
         Verify payment status with Stripe and update invoice if paid
         """
         try:
-            invoice = Invoice.objects.get(token=token)
+            invoice = Invoice.objects.for_payment().get(token=token)
         except Invoice.DoesNotExist:
             return Response(
                 {"error": "Invoice not found"},
@@ -489,7 +669,8 @@ class VerifyPaymentStatus(APIView):
                     "amount_paid": str(invoice.amount_paid),
                     "amount_due": str(invoice.amount_due),
                     "is_paid": invoice.is_paid
-                }
+                },
+                "payment_steps": payment_steps_status(invoice)
             })
         
         # Check if we have a checkout session ID
@@ -499,6 +680,20 @@ class VerifyPaymentStatus(APIView):
                 "message": "No payment session found for this invoice"
             })
         
+        # The Stripe webhook records the outcome locally; Stripe itself is only asked
+        # when that has not happened, at most once per fallback interval per invoice
+        if not payment_state.stripe_fallback_allowed(invoice.token):
+            return Response({
+                "status": invoice.payment_state,
+                "message": "Waiting for payment confirmation",
+                "invoice": {
+                    "status": invoice.status,
+                    "amount_paid": str(invoice.amount_paid),
+                    "amount_due": str(invoice.amount_due),
+                    "is_paid": invoice.is_paid
+                }
+            })
+
         # Initialize Stripe
         stripe_secret_key = settings.STRIPE_SECRET_KEY
         if not stripe_secret_key:
@@ -507,66 +702,16 @@ class VerifyPaymentStatus(APIView):
                 status=500
             )
         
-        stripe.api_key = stripe_secret_key
-        
         try:
             # Retrieve the checkout session from Stripe
-            session = stripe.checkout.Session.retrieve(invoice.stripe_checkout_session_id)
+            session = get_stripe_client().v1.checkout.sessions.retrieve(invoice.stripe_checkout_session_id)
+            invoice = payment_state.sync_from_session(invoice, session)
             
             # Check payment status
             if session.payment_status == 'paid':
-                # Payment was successful - update invoice
-                payment_intent_id = session.payment_intent
-                if payment_intent_id:
-                    invoice.stripe_payment_intent_id = payment_intent_id
-
-                # Get amount paid from session (may include tip; GHL gets invoice amount only)
-                amount_total = session.amount_total or 0  # Amount in cents
-                amount_paid = float(amount_total) / 100  # Convert to dollars
-                metadata = getattr(session, 'metadata', None) or {}
-                tip_amount_str = metadata.get('tip_amount')
-                tip_notes = metadata.get('tip_notes') or 'Customer tip from payment'
-
-                # Check if invoice was already paid to avoid duplicate GHL calls
-                was_already_paid = invoice.is_paid
-                # GHL: record only invoice amount (not tip)
-                ghl_amount = float(invoice.amount_due)
-
-                # Update invoice status and store tip if present
-                invoice.status = 'paid'
-                invoice.amount_paid = amount_paid
-                invoice.amount_due = max(0, float(invoice.total) - amount_paid)
-                if tip_amount_str:
-                    try:
-                        invoice.tip_amount = float(tip_amount_str)
-                        invoice.tip_notes = tip_notes or None
-                    except (TypeError, ValueError):
-                        pass
-                invoice.save()
-
-                # Record payment in GHL: invoice total only (tip is not added to GHL)
-                ghl_result = {"success": False, "error": "Already processed"}
-                tag_result = {"success": False, "error": "Already processed"}
-                if not was_already_paid:
-                    ghl_result = record_payment_in_ghl(invoice, ghl_amount)
-                    if not ghl_result.get("success"):
-                        print(f"Warning: Failed to record payment in GHL: {ghl_result.get('error')}")
-
-                    tag_result = add_invoice_paid_tag_to_contact(invoice.contact_id, invoice.location_id)
-                    if tag_result.get("success"):
-                        print(f"Successfully added invoice_paid tag to contact {invoice.contact_id}")
-                    else:
-                        print(f"Warning: Failed to add invoice_paid tag to contact {invoice.contact_id}: {tag_result.get('error')}")
-
-                # If customer added a tip, trigger Service Pilot tip webhook
-                if tip_amount_str and invoice.job_id:
-                    try:
-                        tip_amount_val = float(tip_amount_str)
-                        if tip_amount_val > 0:
-                            trigger_tip_webhook(invoice.job_id, tip_amount_val, tip_notes)
-                    except (TypeError, ValueError):
-                        pass
-
+                # GHL / Service Pilot calls are queued (queue_payment_steps) so the
+                # customer only waits for the invoice write
+                steps = payment_steps_status(invoice)
                 return Response({
                     "status": "paid",
                     "message": "Payment verified and invoice updated",
@@ -576,8 +721,9 @@ class VerifyPaymentStatus(APIView):
                         "amount_due": str(invoice.amount_due),
                         "is_paid": invoice.is_paid
                     },
-                    "ghl_payment_recorded": ghl_result.get("success", False),
-                    "tag_added": tag_result.get("success", False)
+                    "payment_steps": steps,
+                    "ghl_payment_recorded": steps.get("ghl_payment") == "succeeded",
+                    "tag_added": steps.get("ghl_paid_tag") == "succeeded"
                 })
             else:
                 # Payment not yet completed
@@ -608,9 +754,74 @@ class VerifyPaymentStatus(APIView):
             )
 
 
+class InvoicePaymentStatusView(APIView):
+    """
+    Long-poll an invoice's payment state.
+
+    ?since=<state> waits (up to ?timeout seconds, capped by PAYMENT_STATUS_LONG_POLL_TIMEOUT)
+    until the state recorded from the Stripe webhook differs from it; without `since` the
+    current state is returned straight away. If the wait times out on an unpaid checkout,
+    Stripe is asked directly (throttled per invoice) in case the webhook was missed.
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request, token):
+        since = request.query_params.get("since")
+        try:
+            timeout = float(request.query_params.get("timeout", settings.PAYMENT_STATUS_LONG_POLL_TIMEOUT))
+        except ValueError:
+            timeout = settings.PAYMENT_STATUS_LONG_POLL_TIMEOUT
+        timeout = max(0, min(timeout, settings.PAYMENT_STATUS_LONG_POLL_TIMEOUT))
+
+        try:
+            if since:
+                invoice = payment_state.wait_for_change(token, since, timeout)
+            else:
+                invoice = Invoice.objects.for_payment().get(token=token)
+        except Invoice.DoesNotExist:
+            return Response({"error": "Invoice not found"}, status=404)
+
+        source = "webhook"
+        if (since and invoice.payment_state == since and not invoice.is_paid
+                and invoice.stripe_checkout_session_id and settings.STRIPE_SECRET_KEY
+                and payment_state.stripe_fallback_allowed(invoice.token)):
+            try:
+                session = get_stripe_client().v1.checkout.sessions.retrieve(invoice.stripe_checkout_session_id)
+                invoice = payment_state.sync_from_session(invoice, session)
+                source = "stripe"
+            except stripe.error.StripeError as e:
+                print(f"Stripe error checking payment for invoice {token}: {e}")
+
+        data = {
+            "state": invoice.payment_state,
+            "changed": invoice.payment_state != since,
+            "source": source,
+            "invoice": {
+                "status": invoice.status,
+                "amount_paid": str(invoice.amount_paid),
+                "amount_due": str(invoice.amount_due),
+                "is_paid": invoice.is_paid
+            },
+        }
+        if invoice.is_paid:
+            data["payment_steps"] = payment_steps_status(invoice)
+        response = Response(data)
+        response["Cache-Control"] = "no-store"
+        return response
+
+
+def checkout_fingerprint(line_items, metadata):
+    """SHA-256 of everything a checkout session charges for; a changed amount, tip or currency changes it"""
+    canonical = json.dumps([line_items, metadata], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 class CreateStripeCheckoutSession(APIView):
     """
-    Create a Stripe Checkout Session for invoice payment
+    Create a Stripe Checkout Session for invoice payment. The invoice's open session is
+    handed out again (no Stripe call) while it charges the same thing, has not expired and
+    no payment attempt on it has completed or failed (payment_state is still unpaid).
     """
     permission_classes = [AllowAny]
     authentication_classes = []
@@ -629,7 +840,7 @@ class CreateStripeCheckoutSession(APIView):
                 )
             
             # Get invoice
-            invoice = Invoice.objects.get(token=token)
+            invoice = Invoice.objects.for_payment().get(token=token)
             
             # Check if already paid
             if invoice.is_paid:
@@ -639,7 +850,7 @@ class CreateStripeCheckoutSession(APIView):
                 )
             
             # Check if signature is required
-            if not invoice.signature:
+            if not invoice.signed_at:
                 return Response(
                     {"error": "Please sign the invoice before proceeding with payment"},
                     status=400
@@ -661,8 +872,6 @@ class CreateStripeCheckoutSession(APIView):
                     status=500
                 )
             
-            stripe.api_key = stripe_secret_key
-            
             # Get frontend URL for success/cancel redirects
             frontend_url = settings.FRONTEND_URL or "http://localhost:5173"
             frontend_url = frontend_url.rstrip('/')
@@ -678,56 +887,107 @@ class CreateStripeCheckoutSession(APIView):
             else:
                 tip_amount = 0
 
-            # Charge: invoice amount due + optional tip. GHL gets only invoice amount; tip triggers Service Pilot webhook.
-            amount_invoice = float(invoice.amount_due)
-            amount_to_charge = amount_invoice + tip_amount
-
-            line_items = [{
-                'price_data': {
-                    'currency': invoice.currency.lower(),
-                    'product_data': {
-                        'name': f"Invoice #{invoice.invoice_number or 'N/A'}",
-                        'description': invoice.name,
-                    },
-                    'unit_amount': int(round(amount_invoice * 100)),
-                },
-                'quantity': 1,
-            }]
-            if tip_amount > 0:
-                line_items.append({
+            with transaction.atomic():
+                # Locked so a double-click waits for the first session and then reuses it
+                invoice = Invoice.objects.for_payment().select_for_update().get(pk=invoice.pk)
+                if invoice.is_paid:
+                    return Response(
+                        {"error": "Invoice is already paid"},
+                        status=400
+                    )
+                if not invoice.signed_at:
+                    return Response(
+                        {"error": "Please sign the invoice before proceeding with payment"},
+                        status=400
+                    )
+                if invoice.amount_due <= 0:
+                    return Response(
+                        {"error": "No amount due for this invoice"},
+                        status=400
+                    )
+
+                # Charge: invoice amount due + optional tip. GHL gets only invoice amount; tip triggers Service Pilot webhook.
+                amount_invoice = float(invoice.amount_due)
+                amount_to_charge = amount_invoice + tip_amount
+
+                line_items = [{
                     'price_data': {
                         'currency': invoice.currency.lower(),
                         'product_data': {
-                            'name': 'Tip',
-                            'description': tip_notes or 'Customer tip from payment',
+                            'name': f"Invoice #{invoice.invoice_number or 'N/A'}",
+                            'description': invoice.name,
                         },
-                        'unit_amount': int(round(tip_amount * 100)),
+                        'unit_amount': int(round(amount_invoice * 100)),
                     },
                     'quantity': 1,
+                }]
+                if tip_amount > 0:
+                    line_items.append({
+                        'price_data': {
+                            'currency': invoice.currency.lower(),
+                            'product_data': {
+                                'name': 'Tip',
+                                'description': tip_notes or 'Customer tip from payment',
+                            },
+                            'unit_amount': int(round(tip_amount * 100)),
+                        },
+                        'quantity': 1,
+                    })
+
+                metadata = {
+                    'invoice_token': str(invoice.token),
+                    'invoice_id': str(invoice.id),
+                    'invoice_number': invoice.invoice_number or '',
+                }
+                if tip_amount > 0:
+                    metadata['tip_amount'] = str(round(tip_amount, 2))
+                    metadata['tip_notes'] = (tip_notes or '').strip() or 'Customer tip from payment'
+
+                fingerprint = checkout_fingerprint(line_items, metadata)
+
+                reuse_until = timezone.now() + timedelta(seconds=settings.STRIPE_CHECKOUT_REUSE_MARGIN)
+                if (invoice.stripe_checkout_session_id and invoice.stripe_checkout_url
+                        and invoice.stripe_checkout_fingerprint == fingerprint
+                        and invoice.stripe_checkout_expires_at and invoice.stripe_checkout_expires_at > reuse_until
+                        and invoice.payment_state == 'unpaid'):
+                    return Response({
+                        'checkout_url': invoice.stripe_checkout_url,
+                        'session_id': invoice.stripe_checkout_session_id
+                    })
+
+                # The open session being replaced must not stay payable alongside the new one
+                old_session_id = invoice.stripe_checkout_session_id
+                if old_session_id and invoice.stripe_checkout_expires_at and invoice.stripe_checkout_expires_at > timezone.now():
+                    try:
+                        get_stripe_client().v1.checkout.sessions.expire(old_session_id)
+                    except stripe.error.InvalidRequestError as e:
+                        # Already expired or completed
+                        print(f"Checkout session {old_session_id} not expired: {e}")
+
+                checkout_session = get_stripe_client().v1.checkout.sessions.create(params={
+                    'payment_method_types': ['card'],
+                    'line_items': line_items,
+                    'mode': 'payment',
+                    'success_url': f'{frontend_url}/invoice/{token}/?payment=success',
+                    'cancel_url': f'{frontend_url}/invoice/{token}/?payment=cancelled',
+                    'customer_email': invoice.contact_email,
+                    'metadata': metadata,
+                    'expires_at': int(time.time()) + settings.STRIPE_CHECKOUT_SESSION_TTL,
                 })
 
-            metadata = {
-                'invoice_token': str(invoice.token),
-                'invoice_id': str(invoice.id),
-                'invoice_number': invoice.invoice_number or '',
-            }
-            if tip_amount > 0:
-                metadata['tip_amount'] = str(round(tip_amount, 2))
-                metadata['tip_notes'] = (tip_notes or '').strip() or 'Customer tip from payment'
-
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=line_items,
-                mode='payment',
-                success_url=f'{frontend_url}/invoice/{token}/?payment=success',
-                cancel_url=f'{frontend_url}/invoice/{token}/?payment=cancelled',
-                customer_email=invoice.contact_email,
-                metadata=metadata,
-            )
-            
-            # Save checkout session ID to invoice
-            invoice.stripe_checkout_session_id = checkout_session.id
-            invoice.save()
+                # Save checkout session to invoice; a new session starts a new payment attempt
+                invoice.stripe_checkout_session_id = checkout_session.id
+                invoice.stripe_checkout_url = checkout_session.url
+                invoice.stripe_checkout_fingerprint = fingerprint
+                invoice.stripe_checkout_expires_at = datetime.fromtimestamp(checkout_session.expires_at, tz=dt_timezone.utc)
+                state_changed = invoice.payment_state != 'unpaid'
+                invoice.payment_state = 'unpaid'
+                invoice.save(update_fields=[
+                    "stripe_checkout_session_id", "stripe_checkout_url", "stripe_checkout_fingerprint",
+                    "stripe_checkout_expires_at", "payment_state", "updated_at",
+                ])
+                if state_changed:
+                    payment_state.publish(invoice)
             
             return Response({
                 'checkout_url': checkout_session.url,
@@ -756,6 +1016,7 @@ class CreateStripeCheckoutSession(APIView):
 
 
 @csrf_exempt
+@idempotent_webhook("stripe", stripe_event_key)
 def stripe_webhook_handler(request):
     """
     Handle Stripe webhook events (without verification for now)
@@ -771,6 +1032,7 @@ def stripe_webhook_handler(request):
         
         data = json.loads(payload)
         event_type = data.get('type')
+        log_webhook("stripe", data, event_type)
         
         print(f"Received Stripe webhook: {event_type}")
         
@@ -783,99 +1045,63 @@ def stripe_webhook_handler(request):
             if payment_status == 'paid':
                 # Find invoice by checkout session ID
                 try:
-                    invoice = Invoice.objects.get(stripe_checkout_session_id=session_id)
-                    
-                    # Get payment intent details
-                    payment_intent_id = session.get('payment_intent')
-                    if payment_intent_id:
-                        invoice.stripe_payment_intent_id = payment_intent_id
-                    
-                    # Get amount paid from session (may include tip; GHL gets invoice amount only)
-                    amount_total = session.get('amount_total', 0)  # Amount in cents
-                    amount_paid = float(amount_total) / 100  # Convert to dollars
-                    metadata = session.get('metadata') or {}
-                    tip_amount_str = metadata.get('tip_amount')
-                    tip_notes = metadata.get('tip_notes') or 'Customer tip from payment'
-
-                    # Check if invoice was already paid to avoid duplicate GHL calls
-                    was_already_paid = invoice.is_paid
-                    # GHL: record only invoice amount (not tip)
-                    ghl_amount = float(invoice.amount_due)
-
-                    # Update invoice status and store tip if present
-                    invoice.status = 'paid'
-                    invoice.amount_paid = amount_paid
-                    invoice.amount_due = max(0, float(invoice.total) - amount_paid)
-                    if tip_amount_str:
-                        try:
-                            invoice.tip_amount = float(tip_amount_str)
-                            invoice.tip_notes = tip_notes or None
-                        except (TypeError, ValueError):
-                            pass
-                    invoice.save()
-
-                    print(f"Invoice {invoice.invoice_number} marked as paid. Amount: ${amount_paid}")
-
-                    # Record payment in GHL: invoice total only (tip is not added to GHL)
-                    if not was_already_paid:
-                        ghl_result = record_payment_in_ghl(invoice, ghl_amount)
-                        if ghl_result.get("success"):
-                            print(f"Payment recorded in GHL for invoice {invoice.invoice_number}")
-                        else:
-                            print(f"Warning: Failed to record payment in GHL for invoice {invoice.invoice_number}: {ghl_result.get('error')}")
-
-                        # Add "invoice_paid" tag to GHL contact
-                        tag_result = add_invoice_paid_tag_to_contact(invoice.contact_id, invoice.location_id)
-                        if tag_result.get("success"):
-                            print(f"Successfully added invoice_paid tag to contact {invoice.contact_id}")
-                        else:
-                            print(f"Warning: Failed to add invoice_paid tag to contact {invoice.contact_id}: {tag_result.get('error')}")
-                    else:
+                    # Only the local state change happens here; GHL and Service Pilot calls
+                    # run as Celery tasks (queue_payment_steps) once this commits
+                    invoice, queued, was_already_paid = payment_state.mark_paid(
+                        {"stripe_checkout_session_id": session_id},
+                        payment_intent_id=session.get('payment_intent'),
+                        amount_total=session.get('amount_total', 0),
+                        metadata=session.get('metadata'),
+                    )
+                    if was_already_paid:
                         print(f"Invoice {invoice.invoice_number} was already marked as paid, skipping GHL payment recording")
-
-                    # If customer added a tip, trigger Service Pilot tip webhook
-                    if tip_amount_str and invoice.job_id:
-                        print("tip_amount_str", tip_amount_str)
-                        print("invoice.job_id", invoice.job_id)
-                        print("tip_notes", tip_notes)
-                        try:
-                            tip_amount_val = float(tip_amount_str)
-                            print("tip_amount_val", tip_amount_val)
-                            if tip_amount_val > 0:
-                                print("triggering tip webhook")
-                                tip_result = trigger_tip_webhook(invoice.job_id, tip_amount_val, tip_notes)
-                                print("tip_result", tip_result)
-                                if tip_result.get("success"):
-                                    print("tip_result success")
-                                    print(f"Tip webhook sent for job_id={invoice.job_id}, tip=${tip_amount_val}")
-                                else:
-                                    print(f"Warning: Tip webhook failed for job_id={invoice.job_id}: {tip_result.get('error')}")
-                        except (TypeError, ValueError) as e:
-                            print("error in tip webhook")
-                            print(e.message)
-                            pass
-                        except Exception as e:
-                            print("error in tip webhook")
-                            print(e)
-                            pass
+                    print(f"Invoice {invoice.invoice_number} marked as paid. Amount: ${invoice.amount_paid}")
+                    print(f"Queued post-payment steps for invoice {invoice.invoice_number}: {queued}")
                 except Invoice.DoesNotExist:
                     print(f"Invoice not found for session: {session_id}")
                 except Exception as e:
                     print(f"Error updating invoice: {e}")
                     import traceback
                     traceback.print_exc()
+            else:
+                # Delayed payment methods complete the session before the money arrives
+                invoice = payment_state.set_state({"stripe_checkout_session_id": session_id}, "processing")
+                if invoice is None:
+                    print(f"Invoice not found for session: {session_id}")
+
+        elif event_type == 'checkout.session.async_payment_succeeded':
+            session = data.get('data', {}).get('object', {})
+            session_id = session.get('id')
+
+            try:
+                invoice, queued, _ = payment_state.mark_paid(
+                    {"stripe_checkout_session_id": session_id},
+                    payment_intent_id=session.get('payment_intent'),
+                    amount_total=session.get('amount_total', 0),
+                    metadata=session.get('metadata'),
+                )
+                print(f"Async payment succeeded for invoice {invoice.invoice_number}. Queued: {queued}")
+            except Invoice.DoesNotExist:
+                print(f"Invoice not found for session: {session_id}")
+
+        elif event_type == 'checkout.session.expired':
+            session = data.get('data', {}).get('object', {})
+            session_id = session.get('id')
+
+            invoice = payment_state.set_state({"stripe_checkout_session_id": session_id}, "expired")
+            if invoice is None:
+                print(f"Invoice not found for session: {session_id}")
         
         elif event_type == 'payment_intent.payment_failed':
             # Payment failed
             payment_intent = data.get('data', {}).get('object', {})
             payment_intent_id = payment_intent.get('id')
             
-            try:
-                invoice = Invoice.objects.get(stripe_payment_intent_id=payment_intent_id)
-                # You might want to add a 'failed' status or keep it as 'sent'
-                # For now, we'll just log it
+            # The invoice keeps its status; the payment page is told the attempt failed
+            invoice = payment_state.set_state({"stripe_payment_intent_id": payment_intent_id}, "failed")
+            if invoice:
                 print(f"Payment failed for invoice {invoice.invoice_number}")
-            except Invoice.DoesNotExist:
+            else:
                 print(f"Invoice not found for payment intent: {payment_intent_id}")
         
         elif event_type == 'checkout.session.async_payment_failed':
@@ -883,10 +1109,10 @@ def stripe_webhook_handler(request):
             session = data.get('data', {}).get('object', {})
             session_id = session.get('id')
             
-            try:
-                invoice = Invoice.objects.get(stripe_checkout_session_id=session_id)
+            invoice = payment_state.set_state({"stripe_checkout_session_id": session_id}, "failed")
+            if invoice:
                 print(f"Async payment failed for invoice {invoice.invoice_number}")
-            except Invoice.DoesNotExist:
+            else:
                 print(f"Invoice not found for session: {session_id}")
         
         return JsonResponse({"status": "success"})
@@ -909,6 +1135,7 @@ def invoice_paid_webhook_handler(request):
     
     try:
         data = json.loads(request.body)
+        log_webhook("ghl_invoice_paid", data)
         ghl_invoice_id = data.get('ghl_invoice_id')
         
         if not ghl_invoice_id:
@@ -918,7 +1145,7 @@ def invoice_paid_webhook_handler(request):
         
         # Fetch invoice by ghl_invoice_id
         try:
-            invoice = Invoice.objects.get(ghl_invoice_id=ghl_invoice_id)
+            invoice = Invoice.objects.for_payment().get(ghl_invoice_id=ghl_invoice_id)
         except Invoice.DoesNotExist:
             return JsonResponse({
                 "error": f"Invoice with ghl_invoice_id '{ghl_invoice_id}' not found"
@@ -935,11 +1162,13 @@ def invoice_paid_webhook_handler(request):
         
         # Mark invoice as paid
         invoice.status = 'paid'
+        invoice.payment_state = 'paid'
         # Set amount_paid to total if not already set
         if invoice.amount_paid == 0:
             invoice.amount_paid = invoice.total
         invoice.amount_due = max(0, float(invoice.total) - float(invoice.amount_paid))
-        invoice.save()
+        invoice.save(update_fields=["status", "payment_state", "amount_paid", "amount_due", "updated_at"])
+        payment_state.publish(invoice)
         
         print(f"Invoice {invoice.invoice_number} (ghl_invoice_id: {ghl_invoice_id}) marked as paid via webhook")
         
@@ -0,0 +1,164 @@
+"""
+Buffered writer for WebhookLog.
+
+Webhook views call log_webhook(), which only appends a JSON line to a Redis list
+(sub-millisecond, no database round trip). The flush_webhook_logs task drains the
+list every few seconds and bulk-inserts the entries. If Redis is unreachable the
+entry is written synchronously so nothing is lost.
+
+On PostgreSQL api_webhooklog is partitioned by month; ensure_partitions() creates
+the upcoming monthly partitions and drop_expired() removes whole partitions older
+than the retention window.
+"""
+import json
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import redis
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import WebhookLog
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "webhook_log:queue"
+TABLE = WebhookLog._meta.db_table
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.WEBHOOK_LOG_REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+    return _client
+
+
+def log_webhook(source, data, event_type=None):
+    """Queue one webhook payload for the audit log"""
+    received_at = timezone.now()
+    if event_type is None and isinstance(data, dict):
+        event_type = data.get("type")
+    entry = {"source": source, "event_type": event_type, "data": data, "received_at": received_at.isoformat()}
+    try:
+        get_redis().rpush(QUEUE_KEY, json.dumps(entry, default=str))
+    except redis.RedisError as e:
+        logger.warning(f"Webhook log buffer unavailable ({e}); writing synchronously")
+        WebhookLog.objects.create(source=source, event_type=event_type, data=data, received_at=received_at)
+
+
+def flush(batch_size=None):
+    """
+    Move buffered entries into WebhookLog in batches.
+
+    Returns:
+        int: Number of entries written
+    """
+    batch_size = batch_size or settings.WEBHOOK_LOG_BATCH_SIZE
+    client = get_redis()
+    written = 0
+    while True:
+        # Take a batch atomically so concurrent flushes never write the same entry twice
+        pipe = client.pipeline()
+        pipe.lrange(QUEUE_KEY, 0, batch_size - 1)
+        pipe.ltrim(QUEUE_KEY, batch_size, -1)
+        raw_entries, _ = pipe.execute()
+        if not raw_entries:
+            return written
+
+        logs = []
+        for raw in raw_entries:
+            entry = json.loads(raw)
+            logs.append(WebhookLog(
+                source=entry["source"],
+                event_type=entry.get("event_type"),
+                data=entry.get("data"),
+                received_at=parse_datetime(entry["received_at"]),
+            ))
+        try:
+            WebhookLog.objects.bulk_create(logs, batch_size=batch_size)
+        except Exception:
+            # Put the batch back at the head of the queue for the next run
+            client.lpush(QUEUE_KEY, *reversed(raw_entries))
+            raise
+        written += len(logs)
+        if len(raw_entries) < batch_size:
+            return written
+
+
+def _month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(value):
+    return _month_start(_month_start(value) + timedelta(days=32))
+
+
+def _partition_name(month):
+    return f"{TABLE}_y{month.year}m{month.month:02d}"
+
+
+def _is_partitioned():
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def ensure_partitions(months_ahead=2):
+    """Create monthly partitions from the current month through `months_ahead` months ahead"""
+    if not _is_partitioned():
+        return
+    month = _month_start(timezone.now())
+    with connection.cursor() as cursor:
+        for _ in range(months_ahead + 1):
+            upper = _next_month(month)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS "{_partition_name(month)}" PARTITION OF "{TABLE}" '
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [month, upper],
+            )
+            month = upper
+
+
+def drop_expired(retention_days=None):
+    """
+    Remove webhook logs older than the retention window. Whole monthly partitions are
+    dropped (no row-by-row delete); anything else is deleted by received_at.
+
+    Returns:
+        list: Names of the dropped partitions
+    """
+    retention_days = retention_days or settings.WEBHOOK_LOG_RETENTION_DAYS
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    dropped = []
+
+    if _is_partitioned():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "WHERE parent.relname = %s",
+                [TABLE],
+            )
+            for (name,) in cursor.fetchall():
+                prefix = f"{TABLE}_y"
+                if not name.startswith(prefix):
+                    continue
+                try:
+                    month = datetime.strptime(name[len(prefix):], "%Ym%m").replace(tzinfo=dt_timezone.utc)
+                except ValueError:
+                    continue
+                if _next_month(month) <= cutoff:
+                    with transaction.atomic():
+                        cursor.execute(f'DROP TABLE IF EXISTS "{name}"')
+                    dropped.append(name)
+
+    # Default partition / unpartitioned databases
+    WebhookLog.objects.filter(received_at__lt=cutoff).delete()
+    return dropped
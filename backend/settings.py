@@ -14,6 +14,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 import os
 from datetime import timedelta
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -126,6 +127,15 @@ DATABASES = {
     }
 }
 
+# Shared cache (search results, public responses). Redis so invalidations made by
+# Celery workers are seen by every web process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/1"),
+    }
+}
+
 
 
 # Password validation
@@ -235,20 +245,130 @@ BASE_URI = os.getenv("BASE_URI")
 PIPELINE_ID = os.getenv("PIPELINE_ID")
 PIPELINE_STAGE_ID = os.getenv("PIPELINE_STAGE_ID")
 
+# Shared GHL HTTP client (ghl_auth.client): pooled keep-alive sessions, timeouts and retries
+GHL_CONNECT_TIMEOUT = float(os.getenv("GHL_CONNECT_TIMEOUT", 5))
+GHL_READ_TIMEOUT = float(os.getenv("GHL_READ_TIMEOUT", 30))
+GHL_MAX_RETRIES = int(os.getenv("GHL_MAX_RETRIES", 3))
+GHL_BACKOFF_BASE = 0.5  # seconds, doubled per attempt
+GHL_BACKOFF_MAX = 8  # cap for a single backoff sleep
+GHL_MAX_RETRY_AFTER = 30  # never honour a 429 Retry-After longer than this
+GHL_POOL_CONNECTIONS = 4
+GHL_POOL_MAXSIZE = 10
+
+# OAuth refresh: tokens expiring within this many seconds are refreshed by the beat job
+GHL_TOKEN_REFRESH_MARGIN = int(os.getenv("GHL_TOKEN_REFRESH_MARGIN", 2 * 60 * 60))
+GHL_TOKEN_REFRESH_WORKERS = int(os.getenv("GHL_TOKEN_REFRESH_WORKERS", 4))
+
+# In-process GHL credentials registry (ghl_auth.registry); writers invalidate it, other processes reload after this
+GHL_CREDENTIALS_CACHE_TTL = int(os.getenv("GHL_CREDENTIALS_CACHE_TTL", 60))
+
+# How long a resolved GHL product id (api.models.GHLProduct) is trusted before searching GHL again.
+# Keep it longer than the daily catalog sync so synced rows stay fresh between runs.
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 48 * 60 * 60))
+# While a location's last full catalog sync is younger than this, a name missing from
+# GHLProduct is treated as a new product and created without searching GHL first.
+PRODUCT_CATALOG_MAX_AGE = int(os.getenv("PRODUCT_CATALOG_MAX_AGE", 26 * 60 * 60))
+
+# Threads in the process-wide pool that resolves invoice products in parallel
+INVOICE_PRODUCT_WORKERS = int(os.getenv("INVOICE_PRODUCT_WORKERS", 4))
+
+# When enabled, the invoice webhook only queues the work on Celery and returns 202
+# with the future invoice URL; progress is exposed on /api/webhook/status/<token>/.
+INVOICE_WEBHOOK_ASYNC = os.getenv("INVOICE_WEBHOOK_ASYNC", "False").lower() in ("1", "true", "yes")
+
+# Assignee-picker (GHLUserSearchView) result cache lifetime, in seconds
+GHL_USER_SEARCH_CACHE_TTL = int(os.getenv("GHL_USER_SEARCH_CACHE_TTL", 30))
+
+# ServicesView: how long the external catalog's (max(updated_at), count) version is trusted
+# before re-checking, and how long each serialized page is kept (keys change with the version)
+SERVICE_CATALOG_VERSION_TTL = int(os.getenv("SERVICE_CATALOG_VERSION_TTL", 60))
+SERVICE_CATALOG_CACHE_TTL = int(os.getenv("SERVICE_CATALOG_CACHE_TTL", 60 * 60 * 24))
+
+# Cached public invoice payloads (PublicInvoiceView); dropped whenever the invoice or its items are saved
+PUBLIC_INVOICE_CACHE_TTL = int(os.getenv("PUBLIC_INVOICE_CACHE_TTL", 60 * 60 * 24))
+
+# Webhook audit log (api.webhook_log): Redis buffer, flush batch size and retention
+WEBHOOK_LOG_REDIS_URL = os.getenv("WEBHOOK_LOG_REDIS_URL", "redis://localhost:6379/2")
+WEBHOOK_LOG_BATCH_SIZE = int(os.getenv("WEBHOOK_LOG_BATCH_SIZE", 500))
+WEBHOOK_LOG_RETENTION_DAYS = int(os.getenv("WEBHOOK_LOG_RETENTION_DAYS", 90))
+
+# Inbound webhook dedup (api.idempotency): how long a delivery key is remembered per endpoint,
+# in seconds, and when a claim still "processing" is considered abandoned
+WEBHOOK_IDEMPOTENCY_DEFAULT_WINDOW = 60 * 60 * 24
+WEBHOOK_IDEMPOTENCY_WINDOWS = {
+    "ghl_invoice": int(os.getenv("GHL_INVOICE_WEBHOOK_DEDUP_WINDOW", 60 * 60 * 24)),
+    # Stripe retries failed deliveries for up to three days
+    "stripe": int(os.getenv("STRIPE_WEBHOOK_DEDUP_WINDOW", 60 * 60 * 24 * 7)),
+}
+WEBHOOK_IDEMPOTENCY_PROCESSING_TIMEOUT = int(os.getenv("WEBHOOK_IDEMPOTENCY_PROCESSING_TIMEOUT", 300))
+
+# Retry backoff (seconds) for the post-payment Celery tasks (GHL payment record, paid tag, tip webhook)
+PAYMENT_STEP_BACKOFF_BASE = int(os.getenv("PAYMENT_STEP_BACKOFF_BASE", 30))
+PAYMENT_STEP_BACKOFF_MAX = int(os.getenv("PAYMENT_STEP_BACKOFF_MAX", 60 * 30))
+
+# Payment status long-poll (api.payment_state): Redis pub/sub for state changes, the longest
+# wait per request, how often a waiting request re-reads the invoice, and how often (per
+# invoice) Stripe may be asked directly when the webhook has not arrived
+PAYMENT_STATUS_REDIS_URL = os.getenv("PAYMENT_STATUS_REDIS_URL", "redis://localhost:6379/3")
+PAYMENT_STATUS_LONG_POLL_TIMEOUT = int(os.getenv("PAYMENT_STATUS_LONG_POLL_TIMEOUT", 25))
+PAYMENT_STATUS_POLL_INTERVAL = int(os.getenv("PAYMENT_STATUS_POLL_INTERVAL", 5))
+PAYMENT_STATUS_STRIPE_FALLBACK_INTERVAL = int(os.getenv("PAYMENT_STATUS_STRIPE_FALLBACK_INTERVAL", 30))
+
+# Largest accepted (decoded) signature image, in bytes
+INVOICE_SIGNATURE_MAX_BYTES = int(os.getenv("INVOICE_SIGNATURE_MAX_BYTES", 2 * 1024 * 1024))
+
 # Stripe Configuration
 
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY_TEST")
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY_TEST")
 
+# Shared StripeClient (api.stripe_client): retries for transient network errors, and timeouts in seconds
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", 2))
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", 5))
+STRIPE_READ_TIMEOUT = float(os.getenv("STRIPE_READ_TIMEOUT", 20))
+
+# Lifetime of a checkout session (Stripe allows 30 minutes to 24 hours), and how much of it must
+# be left for CreateStripeCheckoutSession to hand the same session out again
+STRIPE_CHECKOUT_SESSION_TTL = int(os.getenv("STRIPE_CHECKOUT_SESSION_TTL", 60 * 60))
+STRIPE_CHECKOUT_REUSE_MARGIN = int(os.getenv("STRIPE_CHECKOUT_REUSE_MARGIN", 5 * 60))
+
 # print(STRIPE_SECRET_KEY, 'STRIPE_SECRET_KEY')
 # print(STRIPE_PUBLISHABLE_KEY, 'STRIPE_PUBLISHABLE_KEY')
 # STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")  # Add this later for webhook verification
 
 # Refresh GHL OAuth tokens periodically. GHL access tokens last ~24h; refresh token lasts longer.
-# Twice daily keeps healthy margin before expiry without hammering the token endpoint.
+# The job runs often but only refreshes tokens expiring within GHL_TOKEN_REFRESH_MARGIN, so each
+# run is short; a 401 mid-request also triggers a single on-demand refresh (ghl_auth.oauth).
 CELERY_BEAT_SCHEDULE = {
     'refresh-ghl-oauth-tokens': {
         'task': 'api.tasks.make_api_call',
-        'schedule': timedelta(hours=12),
+        'schedule': timedelta(minutes=15),
+    },
+    # Full GHL product catalog sync, off-peak (08:00 UTC = 2-3am America/Chicago)
+    'sync-ghl-product-catalog': {
+        'task': 'api.tasks.sync_product_catalog',
+        'schedule': crontab(hour=8, minute=0),
+    },
+    # Contact search mirror: incremental by `timestamp`, plus a nightly full pass that drops deleted contacts
+    'sync-contact-search': {
+        'task': 'api.tasks.sync_contact_search',
+        'schedule': timedelta(minutes=5),
+    },
+    'sync-contact-search-full': {
+        'task': 'api.tasks.sync_contact_search',
+        'schedule': crontab(hour=8, minute=30),
+        'kwargs': {'full': True},
+    },
+    'flush-webhook-logs': {
+        'task': 'api.tasks.flush_webhook_logs',
+        'schedule': timedelta(seconds=10),
+    },
+    'prune-webhook-logs': {
+        'task': 'api.tasks.prune_webhook_logs',
+        'schedule': crontab(hour=9, minute=0),
+    },
+    'prune-webhook-deliveries': {
+        'task': 'api.tasks.prune_webhook_deliveries',
+        'schedule': crontab(hour=9, minute=15),
     },
 }
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Shared HTTP client for all GoHighLevel (GHL) API traffic.
+
+Every worker thread keeps one keep-alive requests.Session so repeated GHL calls
+reuse pooled TLS connections instead of opening a new one per call. Requests get
+default connect/read timeouts, jittered exponential backoff on transient errors
+and honour the Retry-After header on 429 responses. A 401 on a Bearer-authenticated
+request triggers one single-flight token refresh (ghl_auth.oauth) and a retry.
+"""
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+GHL_BASE_URL = "https://services.leadconnectorhq.com"
+GHL_API_VERSION = "2021-07-28"
+
+# Methods that are safe to replay after a 5xx or a read timeout. POSTs are only
+# retried when GHL never processed them (connection errors and 429s).
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+_local = threading.local()
+
+
+def get_session():
+    """Return this thread's pooled keep-alive session, creating it on first use."""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=settings.GHL_POOL_CONNECTIONS,
+            pool_maxsize=settings.GHL_POOL_MAXSIZE,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _local.session = session
+    return session
+
+
+def never_sent(exc):
+    """True when the request failed before reaching GHL, so any method is safe to replay."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.Timeout):
+        return False
+    reason = exc.args[0] if exc.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, NewConnectionError)
+
+
+def _refresh_after_401(kwargs):
+    """Refresh the rejected Bearer token and swap it into kwargs. Returns True when the request can be retried."""
+    headers = kwargs.get("headers") or {}
+    authorization = headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        return False
+
+    from .oauth import refresh_after_unauthorized
+    credentials = refresh_after_unauthorized(authorization[len("Bearer "):])
+    if not credentials:
+        return False
+    kwargs["headers"] = {**headers, "Authorization": f"Bearer {credentials.access_token}"}
+    return True
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, min(seconds, settings.GHL_MAX_RETRY_AFTER))
+
+
+def _backoff_seconds(attempt):
+    # Full jitter: sleep anywhere between 0 and the capped exponential delay
+    delay = min(settings.GHL_BACKOFF_MAX, settings.GHL_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(0, delay)
+
+
+def request(method, url, timeout=None, max_retries=None, **kwargs):
+    """
+    Send a request to GHL through the pooled session.
+
+    Args:
+        method (str): HTTP method
+        url (str): Absolute URL or a path relative to GHL_BASE_URL
+        timeout: (connect, read) tuple; defaults to the GHL_*_TIMEOUT settings
+        max_retries (int, optional): Overrides settings.GHL_MAX_RETRIES
+        **kwargs: Passed through to requests (headers, params, json, data, ...)
+
+    Returns:
+        requests.Response: The final response (a 429/5xx is returned once retries run out)
+
+    Raises:
+        requests.exceptions.RequestException: When the request still fails after all retries
+    """
+    method = method.upper()
+    if not url.startswith("http"):
+        url = f"{GHL_BASE_URL}/{url.lstrip('/')}"
+    if timeout is None:
+        timeout = (settings.GHL_CONNECT_TIMEOUT, settings.GHL_READ_TIMEOUT)
+    if max_retries is None:
+        max_retries = settings.GHL_MAX_RETRIES
+
+    idempotent = method in IDEMPOTENT_METHODS
+    attempt = 0
+    auth_refreshed = False
+    while True:
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if not (idempotent or never_sent(e)) or attempt >= max_retries:
+                raise
+            delay = _backoff_seconds(attempt)
+            logger.warning(f"GHL {method} {url} failed ({e}); retrying in {delay:.2f}s")
+        else:
+            if response.status_code == 401 and not auth_refreshed:
+                auth_refreshed = True
+                if _refresh_after_401(kwargs):
+                    logger.warning(f"GHL {method} {url} returned 401; retrying with a refreshed token")
+                    continue
+                return response
+            elif response.status_code == 429:
+                if attempt >= max_retries:
+                    return response
+                delay = _retry_after_seconds(response)
+                if delay is None:
+                    delay = _backoff_seconds(attempt)
+                logger.warning(f"GHL {method} {url} rate limited; retrying in {delay:.2f}s")
+            elif response.status_code in RETRY_STATUS_CODES and idempotent:
+                if attempt >= max_retries:
+                    return response
+                delay = _backoff_seconds(attempt)
+                logger.warning(f"GHL {method} {url} returned {response.status_code}; retrying in {delay:.2f}s")
+            else:
+                return response
+
+        attempt += 1
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
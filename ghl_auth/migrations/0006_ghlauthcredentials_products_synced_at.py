@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0005_alter_ghluser_email_alter_ghluser_first_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghlauthcredentials',
+            name='products_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
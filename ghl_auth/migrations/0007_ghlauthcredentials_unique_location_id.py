@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0006_ghlauthcredentials_products_synced_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ghlauthcredentials',
+            name='location_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
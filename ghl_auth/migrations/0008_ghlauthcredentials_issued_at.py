@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0007_ghlauthcredentials_unique_location_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghlauthcredentials',
+            name='issued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
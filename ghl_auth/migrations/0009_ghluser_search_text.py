@@ -0,0 +1,44 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:18
+
+import re
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+def populate_search_text(apps, schema_editor):
+    # Same words as GHLUser.build_search_text()
+    GHLUser = apps.get_model('ghl_auth', 'GHLUser')
+    users = list(GHLUser.objects.all())
+    for user in users:
+        words = []
+        for value in (user.user_id, user.first_name, user.last_name, user.name, user.email, user.phone):
+            value_words = re.findall(r"[^\W_]+", str(value or "").lower())
+            words.extend(value_words)
+            digit_groups = [word for word in value_words if word.isdigit()]
+            for start in range(len(digit_groups) - 1):
+                words.append("".join(digit_groups[start:]))
+        user.search_text = "".join(f" {word}" for word in words)
+    GHLUser.objects.bulk_update(users, ['search_text'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0008_ghlauthcredentials_issued_at'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='ghluser',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(populate_search_text, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='ghluser',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_text'], name='ghl_user_search_text_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from importlib import import_module
+
+from django.db import migrations
+
+
+def rebuild_search_text(apps, schema_editor):
+    # Databases that ran 0009 before it split on punctuation get the current words
+    import_module('ghl_auth.migrations.0009_ghluser_search_text').populate_search_text(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0009_ghluser_search_text'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_search_text, migrations.RunPython.noop),
+    ]
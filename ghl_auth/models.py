@@ -1,20 +1,46 @@
 from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.utils import timezone
+from datetime import timedelta
+import re
 
 # Create your models here.
 
+SEARCH_WORD_RE = re.compile(r"[^\W_]+")
+
+
+def search_words(value):
+    """Lowercase alphanumeric words of a value: "+1 (555) 123-4567" -> 1, 555, 123, 4567; "john@gmail.com" -> john, gmail, com"""
+    return SEARCH_WORD_RE.findall(str(value or "").lower())
+
 
 class GHLAuthCredentials(models.Model):
     user_id = models.CharField(max_length=255)
     access_token = models.TextField()
     refresh_token = models.TextField()
     expires_in = models.IntegerField()
+    # When access_token was issued; together with expires_in drives the refresh schedule
+    issued_at = models.DateTimeField(null=True, blank=True)
     scope = models.TextField(null=True, blank=True)
     user_type = models.CharField(max_length=50, null=True, blank=True)
     company_id = models.CharField(max_length=255, null=True, blank=True)
-    location_id = models.CharField(max_length=255, null=True, blank=True)
+    location_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    # Last completed full product-catalog sync into api.GHLProduct
+    products_synced_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.user_id} - {self.company_id}"
+
+    @property
+    def expires_at(self):
+        if not self.issued_at or not self.expires_in:
+            return None
+        return self.issued_at + timedelta(seconds=self.expires_in)
+
+    def expires_within(self, seconds):
+        """True when the access token expires in the next `seconds` (or its age is unknown)."""
+        expires_at = self.expires_at
+        return expires_at is None or expires_at <= timezone.now() + timedelta(seconds=seconds)
     
 class GHLUser(models.Model):
     user_id = models.CharField(max_length=50, unique=True)
@@ -26,9 +52,38 @@ class GHLUser(models.Model):
     calendar_id = models.CharField(max_length=50, null=True, blank=True)
     location_id = models.CharField(max_length=50, null=True, blank=True, default="")
     percentage = models.DecimalField(decimal_places=2, max_digits=10, default=20)
+    # Normalized id/name/email/phone words, each preceded by a space so `LIKE '% term%'` is a word-prefix match
+    search_text = models.TextField(blank=True, default="", editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_text'], name='ghl_user_search_text_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
+
+    def build_search_text(self):
+        """
+        Space-prefixed words of the searchable fields, so " <word>" matches a word prefix.
+        Phone-like values also get their digits joined from each digit group onwards,
+        so "5551234567" and "1234567" find "+1 (555) 123-4567".
+        """
+        words = []
+        for value in (self.user_id, self.first_name, self.last_name, self.name, self.email, self.phone):
+            value_words = search_words(value)
+            words.extend(value_words)
+            digit_groups = [word for word in value_words if word.isdigit()]
+            for start in range(len(digit_groups) - 1):
+                words.append("".join(digit_groups[start:]))
+        return "".join(f" {word}" for word in words)
+
+    def save(self, *args, **kwargs):
+        self.search_text = self.build_search_text()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "search_text"}
+        super().save(*args, **kwargs)
     
 class CommissionRule(models.Model):
     ghl_user = models.ForeignKey(GHLUser, on_delete=models.CASCADE, related_name='commission_rules')
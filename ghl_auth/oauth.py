@@ -0,0 +1,124 @@
+"""
+GHL OAuth access-token refresh.
+
+Refreshes are single-flight: the credentials row is locked with select_for_update
+(plus a per-row thread lock inside this process), so when many requests see a 401
+at once only the first one calls the token endpoint and the rest reuse its result.
+A refresh always commits on its own, so it is refused inside a caller's transaction.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import client as ghl_client, registry
+from .models import GHLAuthCredentials
+
+logger = logging.getLogger(__name__)
+
+TOKEN_URL = "https://services.leadconnectorhq.com/oauth/token"
+
+_locks_guard = threading.Lock()
+_locks = {}
+
+
+def _row_lock(pk):
+    with _locks_guard:
+        return _locks.setdefault(pk, threading.Lock())
+
+
+def refresh_access_token(pk, stale_access_token=None, margin=None):
+    """
+    Refresh one location's access token.
+
+    Args:
+        pk (int): GHLAuthCredentials primary key
+        stale_access_token (str, optional): Token GHL just rejected with 401. If the stored
+            token already differs, another worker refreshed it and no call is made.
+        margin (int, optional): Scheduled refresh: only refresh when the token expires
+            within this many seconds (re-checked under the lock).
+
+    Returns:
+        GHLAuthCredentials: Current credentials, or None when the refresh failed or was refused
+    """
+    if connection.in_atomic_block:
+        # Inside the caller's transaction the rotated refresh token would only be stored if
+        # that transaction commits (and the row would stay locked until then). A rollback
+        # would lose it for good, so leave the refresh to a call outside any transaction.
+        logger.warning(f"Not refreshing GHL credentials {pk} inside an open transaction")
+        return None
+
+    with _row_lock(pk):
+        credentials = _refresh_locked(pk, stale_access_token, margin)
+    # After commit, so other threads reload the stored token rather than the old one
+    registry.invalidate()
+    return credentials
+
+
+def _refresh_locked(pk, stale_access_token, margin):
+    with transaction.atomic():
+        credentials = GHLAuthCredentials.objects.select_for_update().get(pk=pk)
+
+        if stale_access_token is not None and credentials.access_token != stale_access_token:
+            return credentials
+        if margin is not None and not credentials.expires_within(margin):
+            return credentials
+
+        logger.info(f"Refreshing token for location: {credentials.location_id}")
+        response = ghl_client.post(
+            TOKEN_URL,
+            data={
+                'grant_type': 'refresh_token',
+                'client_id': settings.GHL_CLIENT_ID,
+                'client_secret': settings.GHL_CLIENT_SECRET,
+                'refresh_token': credentials.refresh_token,
+            },
+            timeout=10
+        )
+
+        if response.status_code != 200:
+            logger.error(
+                f"Token refresh failed for location {credentials.location_id}. "
+                f"Status: {response.status_code}, Response: {response.text}"
+            )
+            return None
+
+        new_tokens = response.json()
+        if 'access_token' not in new_tokens or 'refresh_token' not in new_tokens:
+            logger.error(
+                f"Invalid token response for location {credentials.location_id}: "
+                f"{new_tokens}"
+            )
+            return None
+
+        credentials.access_token = new_tokens.get("access_token")
+        credentials.refresh_token = new_tokens.get("refresh_token")
+        credentials.expires_in = new_tokens.get("expires_in") or credentials.expires_in
+        credentials.issued_at = timezone.now()
+        credentials.scope = new_tokens.get("scope", credentials.scope)
+        credentials.user_type = new_tokens.get("userType", credentials.user_type)
+        credentials.company_id = new_tokens.get("companyId", credentials.company_id)
+        credentials.user_id = new_tokens.get("userId") or credentials.user_id
+        credentials.save()
+
+    logger.info(f"Successfully refreshed credentials for location {credentials.location_id}")
+    return credentials
+
+
+def refresh_after_unauthorized(stale_access_token):
+    """
+    Called by the GHL client when a request using `stale_access_token` got a 401.
+
+    Returns:
+        GHLAuthCredentials with a fresh token, or None when the token is unknown or refresh failed
+    """
+    for credentials in registry.all_credentials():
+        if credentials.access_token == stale_access_token:
+            return refresh_access_token(credentials.pk, stale_access_token=stale_access_token)
+
+    credentials = GHLAuthCredentials.objects.filter(access_token=stale_access_token).first()
+    if credentials:
+        return refresh_access_token(credentials.pk, stale_access_token=stale_access_token)
+    return None
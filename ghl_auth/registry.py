@@ -0,0 +1,66 @@
+"""
+In-process registry of GHL OAuth credentials keyed by location_id.
+
+The whole GHLAuthCredentials table (one row per connected location) is loaded in a
+single query and kept for GHL_CREDENTIALS_CACHE_TTL seconds, so a webhook no longer
+runs the same credentials query four or five times. Code that writes new tokens
+must call invalidate() so this process picks them up immediately; other processes
+reload once the TTL expires.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from .models import GHLAuthCredentials
+
+_lock = threading.Lock()
+_by_location = {}
+_ordered = []
+_loaded_at = None
+
+
+def _load():
+    global _by_location, _ordered, _loaded_at
+    ordered = list(GHLAuthCredentials.objects.order_by("pk"))
+    _by_location = {c.location_id: c for c in ordered if c.location_id}
+    _ordered = ordered
+    _loaded_at = time.monotonic()
+
+
+def _ensure_loaded():
+    with _lock:
+        if _loaded_at is None or time.monotonic() - _loaded_at > settings.GHL_CREDENTIALS_CACHE_TTL:
+            _load()
+
+
+def get_credentials(location_id=None, fallback=True):
+    """
+    Return the credentials for a location.
+
+    Args:
+        location_id (str, optional): GHL location ID
+        fallback (bool): When the location is missing or unknown, return the first
+            connected location's credentials (the old `.first()` behaviour)
+
+    Returns:
+        GHLAuthCredentials or None. Treat the instance as read-only; it is shared.
+    """
+    _ensure_loaded()
+    credentials = _by_location.get(location_id) if location_id else None
+    if credentials is None and fallback and _ordered:
+        credentials = _ordered[0]
+    return credentials
+
+
+def all_credentials():
+    """All connected locations' credentials, in primary key order."""
+    _ensure_loaded()
+    return list(_ordered)
+
+
+def invalidate():
+    """Drop the cached credentials; the next lookup reloads them from the database."""
+    global _loaded_at
+    with _lock:
+        _loaded_at = None
@@ -1,10 +1,17 @@
-from .models import GHLAuthCredentials, GHLUser
+import hashlib
+import time
 
-import requests
+from django.core.cache import cache
+
+from .models import GHLAuthCredentials, GHLUser, search_words
+from . import client as ghl_client
+from .registry import get_credentials
 
 
 def pull_users(locationId):
-    token = GHLAuthCredentials.objects.get(location_id=locationId)
+    token = get_credentials(locationId, fallback=False)
+    if not token:
+        raise GHLAuthCredentials.DoesNotExist(f"No GHL credentials for location {locationId}")
     headers = {
         'Accept': 'application/json',
         'Authorization': f'Bearer {token.access_token}',
@@ -13,7 +20,7 @@ def pull_users(locationId):
     }
 
     # Step 2: Fetch users and save/update GHLUser entries
-    user_response = requests.get(
+    user_response = ghl_client.get(
         f"https://services.leadconnectorhq.com/users/?locationId={locationId}",
         headers=headers
     )
@@ -35,4 +42,45 @@ def pull_users(locationId):
                 "email": user.get("email", ""),
                 "phone": user.get("phone", ""),
                 "location_id": locationId,            }
-        )
\ No newline at end of file
+        )
+
+    invalidate_user_search_cache()
+
+
+USER_SEARCH_VERSION_KEY = "ghl_user_search:version"
+
+
+def _user_search_version():
+    version = cache.get(USER_SEARCH_VERSION_KEY)
+    if version is None:
+        # Start from the clock, not 1, so an evicted version key never revives old entries
+        cache.add(USER_SEARCH_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(USER_SEARCH_VERSION_KEY)
+    return version
+
+
+def user_search_cache_key(search, page=None):
+    """Cache key for one page of assignee-picker results; changes whenever invalidate_user_search_cache() runs"""
+    term = " ".join(search_words(search))
+    digest = hashlib.sha1(term.encode()).hexdigest()
+    return f"ghl_user_search:{_user_search_version()}:{page or 1}:{digest}"
+
+
+def invalidate_user_search_cache():
+    """Expire every cached GHLUser search result (all keys embed the current version)"""
+    try:
+        cache.incr(USER_SEARCH_VERSION_KEY)
+    except ValueError:
+        cache.set(USER_SEARCH_VERSION_KEY, time.time_ns(), None)
+
+
+def search_users(search):
+    """
+    GHLUsers where every word of `search` is the start of a word in their id, name,
+    email or phone, using the trigram-indexed search_text column ("jo sm" finds "John Smith",
+    "gmail" finds "john@gmail.com"). Search terms are split into words the same way.
+    """
+    queryset = GHLUser.objects.order_by("id")
+    for word in search_words(search):
+        queryset = queryset.filter(search_text__contains=f" {word}")
+    return queryset
\ No newline at end of file
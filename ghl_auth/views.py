@@ -4,8 +4,10 @@ from django.http import JsonResponse
 from django.shortcuts import redirect, render
 from urllib.parse import urlencode
 from django.conf import settings
+from django.utils import timezone
 
 from .models import GHLAuthCredentials
+from . import client as ghl_client, registry
 from ghl_auth.utils import pull_users
 from ghl_auth.models import GHLUser
 
@@ -54,7 +56,7 @@ def tokens(request):
         "code": authorization_code,
     }
 
-    response = requests.post(TOKEN_URL, data=data)
+    response = ghl_client.post(TOKEN_URL, data=data)
 
     try:
         response_data = response.json()
@@ -74,12 +76,14 @@ def tokens(request):
                 "access_token": response_data.get("access_token"),
                 "refresh_token": response_data.get("refresh_token"),
                 "expires_in": response_data.get("expires_in"),
+                "issued_at": timezone.now(),
                 "scope": response_data.get("scope"),
                 "user_type": response_data.get("userType"),
                 "company_id": response_data.get("companyId"),
                 "user_id":response_data.get("userId"),
             }
         )
+        registry.invalidate()
 
         pull_users(locationId=response_data.get("locationId"))
         